@@ -0,0 +1,77 @@
+"""Conversion of add_order payloads: the schema-compiled converter versus the former per-field lambda loop.
+
+Usage: python -m benchmarks.add_order_conversion [--events N]
+"""
+import argparse
+from time import perf_counter
+
+from benchmarks.samples import add_orders
+from bitcoinde.countries import Countries
+from bitcoinde.eventhandlers import BitcoinWebSocketAddOrder, map_trust_level
+
+
+def legacy_converter():
+    """The former BitcoinWebSocketAddOrder.retrieve_data (trans dict of lambdas)."""
+    trans = {
+        "id": ("id", lambda x: int(x)),
+        "uid": ("uid", lambda x: x),
+        "order_id": ("order_id", lambda x: x),
+        "price": ("price", lambda x: int(float(x) * 100)),
+        "volume": ("volume", lambda x: int(float(x) * 100)),
+        "bic_full": ("bic_full", lambda x: x),
+        "only_kyc_full": ("only_kyc_full", lambda x: int(x)),
+        "is_kyc_full": ("is_kyc_full", lambda x: int(x)),
+        "is_trade_by_sepa_allowed": ("is_trade_by_sepa_allowed", lambda x: int(x)),
+        "is_trade_by_fidor_reservation_allowed": ("is_trade_by_fidor_reservation_allowed", lambda x: int(x)),
+        "amount": ("amount", lambda x: float(x)),
+        "min_amount": ("min_amount", lambda x: float(x)),
+        "order_type": ("order_type", lambda x: x),
+        "order": ("order", lambda x: x),
+        "min_trust_level": ("min_trust_level", lambda x: map_trust_level(x),),
+        "seat_of_bank_of_creator": ("seat_of_bank_of_creator", Countries.encode),
+        "trading_pair": ("trading_pair", lambda x: x),
+        "trade_to_sepa_country": ("trade_to_sepa_country", Countries.encode),
+        "fidor_account": ("fidor_account", lambda x: int(x))
+    }
+
+    def retrieve_data(data):
+        is_shorting = int(data["is_shorting"])
+        is_shorting_allowed = int(data["is_shorting_allowed"])
+        result = {
+            "id": data["id"],
+            "po": int(data["payment_option"]),
+            "short": is_shorting * 2 + is_shorting_allowed,
+            "is_trade_by_fidor_reservation_allowed": int(data["is_trade_by_fidor_reservation_allowed"]),
+            "is_trade_by_sepa_allowed": int(data["is_trade_by_sepa_allowed"])
+        }
+        for key, mapping_tuple in trans.items():
+            property_name, mapping_func, = mapping_tuple
+            result[property_name] = mapping_func(data.get(key))
+        return result
+
+    return retrieve_data
+
+
+def run(convert, payloads: list) -> float:
+    started = perf_counter()
+    for data in payloads:
+        convert(data)
+    return (perf_counter() - started) / len(payloads) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=100000)
+    args = parser.parse_args()
+
+    payloads = add_orders(args.events)
+    legacy, compiled = legacy_converter(), BitcoinWebSocketAddOrder.convert
+    for data in payloads[:1000]:
+        assert list(legacy(data).items()) == list(compiled(data).items())
+
+    print("legacy:   %.2f us/event" % run(legacy, payloads))
+    print("compiled: %.2f us/event" % run(compiled, payloads))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Request queue of PriorityBitcoinDeAPI (heap and hash index) versus the former linear dedup scan and per-issue sort:
+enqueueing N distinct requests, N duplicates, and issuing all of them. The API runs on a task.Clock, requests are
+handed to an agent that never answers.
+
+bitcoinDEapi is Python 2 code. Usage: python2 -m benchmarks.api_queue [--requests N]
+"""
+import argparse
+from timeit import default_timer as timer
+
+from twisted.internet import task
+from twisted.internet.defer import Deferred
+
+from bitcoinDEapi import PriorityBitcoinDeAPI
+
+
+class SilentAgent(object):
+    def request(self, method, url, headers=None, bodyProducer=None, signer=None):
+        return Deferred()
+
+
+def legacy(n):
+    """The former SameHashInQueue scan on enqueue and the sort of PriorityBitcoinDeAPI.Queue on every issue."""
+    queue, pending = {}, {}
+    started = timer()
+    for eid in range(n):
+        h = hash(("showMyTrades", eid))
+        for k, req in queue.items():
+            if req[1] == h:
+                break
+        queue[eid] = (1, h)
+    enqueued = timer()
+    for eid in range(n):
+        for k, (priority, _) in sorted(queue.items(), key=lambda x: (-x[1][0], x[0])):
+            if k not in pending:
+                pending[k] = 3
+                break
+    issued = timer()
+    return enqueued - started, issued - enqueued
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--legacy-requests", type=int, default=2000)
+    args = parser.parse_args()
+    n = args.requests
+
+    api = PriorityBitcoinDeAPI(task.Clock(), "key", "secret")
+    api.max_inflight = n  # no limit on requests in flight
+    api.agent = SilentAgent()
+    started = timer()
+    for page in range(n):
+        api.APIRequest("showMyTrades", page=page, priority=page % 3)
+    enqueued = timer()
+    for page in range(n):
+        api.APIRequest("showMyTrades", page=page, priority=page % 3)
+    deduplicated = timer()
+    api.credits.Sync(10 ** 9)
+    api.IssueNext()
+    issued = timer()
+    assert len(api.pending) == n
+    print("heap:   enqueue %.1f us, duplicate %.1f us, issue %.1f us per request (%d requests)" % (
+        (enqueued - started) / n * 1e6, (deduplicated - enqueued) / n * 1e6, (issued - deduplicated) / n * 1e6, n))
+
+    m = args.legacy_requests
+    enqueue, issue = legacy(m)
+    print("legacy: enqueue %.1f us, issue %.1f us per request (%d requests, both grow linearly with the queue)" % (
+        enqueue / m * 1e6, issue / m * 1e6, m))
+
+
+if __name__ == '__main__':
+    main()
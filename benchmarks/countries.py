@@ -0,0 +1,59 @@
+"""Bulk filtering of country bitmasks: Countries.eligible on the numpy path versus the list comprehension fallback.
+The round trip and both paths are checked by tests/test_countries.py.
+
+Usage: python -m benchmarks.countries [--masks N]
+"""
+import argparse
+import random
+from time import perf_counter
+
+from bitcoinde import countries
+from bitcoinde.countries import Countries
+
+
+def without_numpy(function, *args):
+    """Calls the given function with the fallback path of bitcoinde.countries."""
+    saved, countries.numpy = countries.numpy, None
+    try:
+        return function(*args)
+    finally:
+        countries.numpy = saved
+
+
+def random_masks(n: int) -> list:
+    rng = random.Random(7)
+    masks = []
+    for _ in range(n):
+        codes = rng.sample(Countries.codes, rng.randint(0, 4))
+        if rng.random() < 0.05:
+            codes.append("US")
+        masks.append(Countries.encode(codes))
+    return masks
+
+
+def run(function, *args):
+    started = perf_counter()
+    result = function(*args)
+    return perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--masks", type=int, default=100000)
+    args = parser.parse_args()
+
+    masks = random_masks(args.masks)
+    n = len(masks)
+    fallback, expected = run(without_numpy, Countries.eligible, masks, "DE")
+    print("eligible, fallback: %.3f us per mask (%d masks)" % (fallback / n * 1e6, n))
+    if countries.numpy is None:
+        print("eligible, numpy:    not installed")
+        return
+    vectorized, result = run(Countries.eligible, masks, "DE")
+    if result.tolist() != expected:
+        raise RuntimeError("numpy and fallback results differ")
+    print("eligible, numpy:    %.3f us per mask (%.1fx)" % (vectorized / n * 1e6, fallback / vectorized))
+
+
+if __name__ == '__main__':
+    main()
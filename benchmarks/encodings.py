@@ -0,0 +1,35 @@
+"""Message size and consumer-side decode time of add events: MessagePack versus the binary layout.
+
+Usage: python -m benchmarks.encodings [--events N]
+"""
+import argparse
+from time import perf_counter
+
+from benchmarks.samples import add_orders
+from bitcoinde.eventhandlers import BitcoinWebSocketAddOrder
+from bitcoinde.messages import unpack_events
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=100000)
+    args = parser.parse_args()
+
+    handler = BitcoinWebSocketAddOrder()
+    events = [handler.process_event(order, 1, 1500000000 + i) for i, order in enumerate(add_orders(args.events))]
+
+    print("encoding  bytes/event  encode us  decode us")
+    for encoding in ("msgpack", "binary"):
+        started = perf_counter()
+        messages = [evt.encode(encoding) for evt in events]
+        encoded = perf_counter()
+        for message in messages:
+            unpack_events(message)
+        decoded = perf_counter()
+        print("%-8s %12.0f %10.2f %10.2f" % (encoding, sum(len(m) for m in messages) / len(messages),
+                                             (encoded - started) / len(events) * 1e6,
+                                             (decoded - encoded) / len(events) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Per-event serialization cost for a growing number of sinks: packing per sink versus the cached Event.encode.
+
+Usage: python -m benchmarks.event_pack [--events N]
+"""
+import argparse
+import sys
+from time import perf_counter
+
+from benchmarks.samples import add_orders
+from bitcoinde.events import Event, pack_msgpack
+
+
+def make_events(n: int) -> list:
+    events = []
+    for i, order in enumerate(add_orders(n, 7)):
+        evt = Event(order["id"], "add", 1500000000 + i)
+        evt.add_data(order)
+        events.append(evt)
+    return events
+
+
+def run(events: list, sinks: int, cached: bool) -> float:
+    """Returns the microseconds spent per event to hand it to the given number of sinks."""
+    started = perf_counter()
+    if cached:
+        for evt in events:
+            for _ in range(sinks):
+                evt.pack()
+    else:
+        for evt in events:
+            for _ in range(sinks):
+                pack_msgpack(evt)
+    return (perf_counter() - started) / len(events) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=100000)
+    args = parser.parse_args()
+
+    events = make_events(args.events)
+    print("Event object: %d bytes (without sources and data)" % sys.getsizeof(events[0]))
+    print("sinks  per sink us  cached us")
+    for sinks in (1, 2, 4, 8):
+        for evt in events:
+            evt.encoded = None
+        print("%5d %12.2f %10.2f" % (sinks, run(events, sinks, False), run(events, sinks, True)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Throughput of WebSocketFrameDecoder on a byte stream cut at random boundaries.
+
+Usage: python -m benchmarks.frames [--events N] [--max-chunk BYTES]
+"""
+import argparse
+import random
+from time import perf_counter
+
+from benchmarks.samples import add_orders, v20_packet, frame
+from bitcoinde.frames import WebSocketFrameDecoder, OPCODE_TEXT, OPCODE_CONTINUATION
+
+
+def record_stream(n: int, seed: int) -> bytes:
+    """Builds a stream of add_order frames, interleaved with pongs, some of them fragmented."""
+    rnd = random.Random(seed)
+    stream = bytearray()
+    for order in add_orders(n, seed):
+        payload = v20_packet("add_order", order)
+        if rnd.random() < 0.05:
+            cut = rnd.randint(1, len(payload) - 1)
+            stream += frame(payload[:cut], OPCODE_TEXT, fin=False)
+            stream += frame(payload[cut:], OPCODE_CONTINUATION)
+        else:
+            stream += frame(payload)
+        if rnd.random() < 0.01:
+            stream += frame(b"3")
+    return bytes(stream)
+
+
+def cut(stream: bytes, max_chunk: int, seed: int) -> list:
+    rnd = random.Random(seed)
+    chunks, pos = [], 0
+    while pos < len(stream):
+        n = rnd.randint(1, max_chunk)
+        chunks.append(stream[pos:pos + n])
+        pos += n
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--max-chunk", type=int, default=16384)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    stream = record_stream(args.events, args.seed)
+    chunks = cut(stream, args.max_chunk, args.seed)
+    counter = [0, 0]
+
+    def on_frame(opcode, payload):
+        counter[0] += 1
+        counter[1] += len(payload)
+
+    decoder = WebSocketFrameDecoder(on_frame)
+    started = perf_counter()
+    for chunk in chunks:
+        decoder.feed(chunk)
+    elapsed = perf_counter() - started
+
+    print("%d bytes in %d chunks -> %d messages (%d payload bytes)" %
+          (len(stream), len(chunks), counter[0], counter[1]))
+    print("%.3f s, %.1f MB/s, %.0f messages/s" % (elapsed, len(stream) / elapsed / 1e6, counter[0] / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Write rate of EventJournal (group-commit fsync) and time-range reads with and without the sparse index.
+
+Usage: python -m benchmarks.journal [--events N] [--directory DIR] [--encoding msgpack|binary]
+"""
+import argparse
+import shutil
+import tempfile
+from time import perf_counter
+
+from benchmarks.samples import add_orders
+from bitcoinde.dispatch import QueuedEventSink
+from bitcoinde.eventhandlers import BitcoinWebSocketAddOrder
+from bitcoinde.journal import EventJournal, JournalReader
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--directory", default=None)
+    parser.add_argument("--encoding", default="msgpack")
+    args = parser.parse_args()
+
+    handler = BitcoinWebSocketAddOrder()
+    events = [handler.process_event(order, 1, 1500000000 + i * 0.05)  # 20 events per second of event time
+              for i, order in enumerate(add_orders(args.events))]
+    directory = args.directory or tempfile.mkdtemp(prefix="journal-")
+
+    journal = EventJournal(directory, args.encoding, segment_bytes=16 * 1024 * 1024)
+    sink = QueuedEventSink(journal, max_size=len(events))
+    started = perf_counter()
+    for evt in events:
+        sink.process_event(evt)
+    enqueued = perf_counter()
+    sink.close()
+    written = perf_counter()
+    print("write: %.0f events/s (%.2f us on the delivering thread), %d segments, %d fsyncs" %
+          (len(events) / (written - started), (enqueued - started) / len(events) * 1e6, journal.sequence,
+           journal.syncs))
+
+    reader = JournalReader(directory)
+    start = events[len(events) * 3 // 4].timestamp
+    end = start + 60.
+    started = perf_counter()
+    n = sum(1 for _ in reader.records(start, end))
+    indexed = perf_counter() - started
+    started = perf_counter()
+    m = sum(1 for timestamp, _ in reader.records() if start <= timestamp <= end)
+    scanned = perf_counter() - started
+    assert n == m
+    print("read 60 s (%d events): %.2f ms with the index, %.2f ms scanning" % (n, indexed * 1e3, scanned * 1e3))
+
+    if args.directory is None:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
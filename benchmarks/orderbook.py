@@ -0,0 +1,65 @@
+"""Replays a generated day of add/rm/po events into OrderBook.
+
+Usage: python -m benchmarks.orderbook [--events-per-second R]
+"""
+import argparse
+import random
+from time import perf_counter
+
+from bitcoinde.events import Event
+from bitcoinde.orderbook import OrderBook
+
+
+def generate_day(events_per_second: float, seed: int) -> list:
+    """Random-walks the mid price over 24 hours; orders are added around it, older orders are removed first."""
+    rnd = random.Random(seed)
+    n = int(events_per_second * 86400)
+    events, live, mid, next_id = [], [], 870000, 1
+    for i in range(n):
+        t = i / events_per_second
+        mid += rnd.randint(-5, 5)
+        r = rnd.random()
+        if r < 0.5 or len(live) < 100:
+            order_type = rnd.choice(("buy", "sell"))
+            offset = int(rnd.expovariate(1 / 2000.))
+            price = mid - offset if order_type == "buy" else mid + offset
+            data = {"id": next_id, "order_id": "O%d" % next_id, "trading_pair": rnd.choice(("btceur", "bcheur")),
+                    "order_type": order_type, "price": price, "amount": round(rnd.uniform(0.01, 3), 4),
+                    "min_amount": 0.01, "po": 1}
+            evt = Event(str(next_id), "add", t)
+            evt.add_data(data)
+            live.append(next_id)
+            next_id += 1
+        elif r < 0.98:
+            oid = live.pop(rnd.randrange(min(len(live), 1000)))
+            evt = Event(str(oid), "rm", t)
+            evt.add_data({"id": str(oid), "type": "order"})
+        else:
+            oids = sorted(set(live[rnd.randrange(len(live))] for _ in range(rnd.randint(1, 5))))
+            evt = Event(str(-oids[0]), "po", t)
+            evt.add_data({"ids": [str(oid) for oid in oids], "po": [rnd.randint(0, 3) for _ in oids]})
+        events.append(evt)
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events-per-second", type=float, default=10.)
+    parser.add_argument("--seed", type=int, default=3)
+    args = parser.parse_args()
+
+    events = generate_day(args.events_per_second, args.seed)
+    book = OrderBook()
+    started = perf_counter()
+    for evt in events:
+        book.process_event(evt)
+    elapsed = perf_counter() - started
+
+    print("%d events in %.3f s, %.0f events/s, %.2f us/event" % (len(events), elapsed, len(events) / elapsed,
+                                                               elapsed * 1e6 / len(events)))
+    for pair, pair_book in sorted(book.books.items()):
+        print("%s: %d bid levels, %d ask levels" % (pair, len(pair_book.bids), len(pair_book.asks)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Generates a capture of three sources (one socket.io 0.9, two 2.0) delivering the same add/remove events with
+jitter, and replays it through the whole pipeline as fast as possible.
+
+Usage: python -m benchmarks.replay [--events N] [--capture PATH]
+"""
+import argparse
+import os
+import random
+import tempfile
+
+from benchmarks.samples import REMOVE_ORDER, add_orders, frame, v09_packet, v20_packet
+from bitcoinDEws import BitcoinWebSocketMulti
+from bitcoinde.capture import CaptureWriter
+from bitcoinde.replay import Replay
+
+SOURCES = ((1, "09", v09_packet), (3, "20", v20_packet), (4, "20", v20_packet))
+
+
+def generate(path: str, n: int, seed: int):
+    """Writes a capture of n events (add_order, later remove_order of the same order) per source."""
+    rnd = random.Random(seed)
+    arrivals, t = [], 1500000000.
+    for order in add_orders(n // 2, seed):
+        for event_type, args in (("add_order", order), ("remove_order", dict(REMOVE_ORDER, id=order["id"]))):
+            t += rnd.expovariate(20.)  # 20 events per second
+            for sid, version, packet in SOURCES:
+                arrivals.append((t + rnd.uniform(0., 0.05), sid, version, frame(packet(event_type, args))))
+    arrivals.sort(key=lambda arrival: arrival[0])
+    writer = CaptureWriter(path)
+    for t, sid, version, data in arrivals:
+        writer.record(t, sid, version, data)
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--capture", default=None)
+    args = parser.parse_args()
+
+    path = args.capture or os.path.join(tempfile.mkdtemp(prefix="replay-"), "synthetic.capture")
+    if not os.path.exists(path):
+        generate(path, args.events, 5)
+
+    report = Replay(BitcoinWebSocketMulti(servers=[]), path).run().report()
+    print("%d chunks, %d events in %.3f s: %.0f events/s" % (report["chunks"], report["events"], report["seconds"],
+                                                             report["events_per_second"]))
+    for stage, stats in report["stages"].items():
+        print("%-8s %9d calls %9.1f us p50 %9.1f us p99" % (stage, stats["calls"], stats["p50_us"], stats["p99_us"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Payloads shaped like the ones recorded from the bitcoin.de websocket endpoints."""
+import json
+import random
+
+ADD_ORDER = {
+    "id": "75573286",
+    "type": "order",
+    "uid": "a9f7c8d3e2b1f0a9c8d7e6f5a4b3c2d1e0f9a8b7",
+    "order_id": "JQM5SA",
+    "order_type": "buy",
+    "order": "",
+    "trading_pair": "btceur",
+    "price": "8731.54",
+    "volume": "4365.77",
+    "amount": "0.5",
+    "min_amount": "0.1",
+    "bic_full": "",
+    "only_kyc_full": "0",
+    "is_kyc_full": "1",
+    "is_shorting": "0",
+    "is_shorting_allowed": "0",
+    "is_trade_by_sepa_allowed": "1",
+    "is_trade_by_fidor_reservation_allowed": "0",
+    "payment_option": "2",
+    "min_trust_level": "silver",
+    "seat_of_bank_of_creator": "DE",
+    "trade_to_sepa_country": ["DE", "AT", "NL", "FR"],
+    "fidor_account": "0"
+}
+
+REMOVE_ORDER = {"id": "75573286", "type": "order", "reason": "order_executed", "trading_pair": "btceur"}
+
+
+def add_orders(n, seed=1):
+    """Generates n distinct add_order payloads."""
+    rnd = random.Random(seed)
+    result = []
+    for i in range(n):
+        order = dict(ADD_ORDER)
+        order["id"] = str(75573286 + i)
+        order["order_id"] = "J%05X" % i
+        order["order_type"] = rnd.choice(("buy", "sell"))
+        order["price"] = "%.2f" % rnd.uniform(8500, 9000)
+        order["amount"] = "%.4f" % rnd.uniform(0.01, 5)
+        result.append(order)
+    return result
+
+
+def v09_packet(event_type, args) -> bytes:
+    """Encodes an event the way socket.io 0.9 servers do."""
+    return ("5:::" + json.dumps({"name": event_type, "args": [args]})).encode("utf8")
+
+
+def v20_packet(event_type, args) -> bytes:
+    """Encodes an event the way socket.io 2.0 servers do."""
+    return b"42/market," + json.dumps([event_type, args]).encode("utf8")
+
+
+def frame(payload: bytes, opcode=0x1, fin=True) -> bytes:
+    """Wraps the payload into an unmasked websocket frame."""
+    head = bytearray([(0x80 if fin else 0) | opcode])
+    n = len(payload)
+    if n < 126:
+        head.append(n)
+    elif n < 1 << 16:
+        head.append(126)
+        head += n.to_bytes(2, "big")
+    else:
+        head.append(127)
+        head += n.to_bytes(8, "big")
+    return bytes(head) + payload
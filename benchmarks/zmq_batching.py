@@ -0,0 +1,83 @@
+"""Throughput and latency of ZeroMqEventProcessingSink for several batch sizes (PUB/SUB over loopback TCP).
+
+Usage: python -m benchmarks.zmq_batching [--events N] [--rate EVENTS_PER_SECOND] [--port PORT]
+
+For each batch size, N events are published back to back (throughput), then N events are published at the given
+rate with a 1 ms maximum delay (latency). The benchmark drives the sink's deadline itself, like a dispatcher does.
+"""
+import argparse
+import threading
+from time import perf_counter, sleep, time
+
+import zmq
+
+from benchmarks.samples import ADD_ORDER
+from bitcoinDEws import ZeroMqEventProcessingSink
+from bitcoinde.events import Event
+from bitcoinde.messages import unpack_events
+
+
+def receive(socket, n, latencies, done):
+    received = 0
+    while received < n:
+        for evt in unpack_events(socket.recv()):
+            latencies.append(perf_counter() - evt["data"]["sent"])
+            received += 1
+    done.set()
+
+
+def publish(sink, socket, n, rate):
+    """Publishes n events; rate=None publishes back to back. Returns (seconds, latencies)."""
+    latencies, done = [], threading.Event()
+    receiver = threading.Thread(target=receive, args=(socket, n, latencies, done))
+    receiver.start()
+    interval = 1. / rate if rate else 0.
+    started = perf_counter()
+    for i in range(n):
+        if interval > 0:
+            while perf_counter() < started + i * interval:
+                deadline = sink.deadline()
+                if deadline is not None and time() >= deadline:
+                    sink.flush()
+        evt = Event(str(i), "add", 0)
+        data = dict(ADD_ORDER)
+        data["sent"] = perf_counter()
+        evt.add_data(data)
+        sink.process_event(evt)
+    sink.flush()
+    done.wait()
+    elapsed = perf_counter() - started
+    receiver.join()
+    return elapsed, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=5000.)
+    parser.add_argument("--port", type=int, default=15634)
+    args = parser.parse_args()
+
+    sink = ZeroMqEventProcessingSink(args.port)
+    sink.open()
+    socket = sink.context.socket(zmq.SUB)
+    socket.setsockopt(zmq.RCVHWM, 0)
+    socket.connect("tcp://127.0.0.1:%d" % args.port)
+    socket.setsockopt(zmq.SUBSCRIBE, b"")
+    sleep(0.5)
+    sink.socket.setsockopt(zmq.SNDHWM, 0)
+
+    print("batch  max events/s   p50 us   p99 us  (at %.0f events/s)" % args.rate)
+    for batch_size in (1, 4, 16, 64, 256):
+        sink.batch_size = batch_size
+        elapsed, _ = publish(sink, socket, args.events, None)
+        _, latencies = publish(sink, socket, args.events, args.rate)
+        print("%5d %14.0f %8.0f %8.0f" % (batch_size, args.events / elapsed,
+                                          latencies[len(latencies) // 2] * 1e6,
+                                          latencies[int(len(latencies) * 0.99)] * 1e6))
+    socket.close()
+    sink.socket.close()
+
+
+if __name__ == '__main__':
+    main()
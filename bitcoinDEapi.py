@@ -27,16 +27,19 @@
 #!/usr/bin/env python2.7
 #coding:utf-8
 
-from json import loads
+from json import loads, dumps
+from copy import deepcopy
+from collections import OrderedDict
 import time
+from heapq import heappush, heappop
 from hashlib import md5,sha256
 from hmac import new as hmac_new
 
 # Building upon twisted 
 from zope.interface import implements
 from twisted.web.iweb import IBodyProducer
-from twisted.internet.defer import Deferred, succeed
-from twisted.web.client import Agent, WebClientContextFactory, HTTPConnectionPool
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.web.client import Agent, WebClientContextFactory, HTTPConnectionPool, Request, URI
 from twisted.web.http_headers import Headers
 from twisted.internet.protocol import Protocol	
 
@@ -45,35 +48,47 @@ from twisted.internet.protocol import Protocol
 # - BitcoinDeAPI get's requests via APIRequest(call,**kwargs) and checks valdity of call and arguments (some) 
 #    The Request is then encoded in the bitcoin.de-API-complient format and handled over to a request-agent (twisted.web.client.Agent)
 #    The agent's deferred is returned, The whole class lays a base for a request-queue (with priority)
-#    The nonce is handled here as well as revocery from nonce-error
+#    Nonces are allocated by a NonceSequencer when the request's connection is ready (SigningAgent),
+#    so several requests can be in flight over a small pool of keep-alive connections
+#    Responses of the public reads are served from a ResponseCache (CACHE_TTLS)
 # 
-# - BitcoinDeAPINonce improves the nonce-error handling in case of back-to-back requests which might arrive out of order
-# - QueuedBitcoinDeAPI implements a request-queue, delaying calls if no credits are available
-#    in addition the same requests (call,params hash) aren't added multiple times to the queue,
-#    but the original request's deferred is shared with the new request (hiding abstraction from the user)
+# - BitcoinDeAPINonce feeds accepted and rejected (error 4) nonces back to the NonceSequencer
+# - QueuedBitcoinDeAPI implements a request-queue, delaying calls until enough credits are available (CreditBucket),
+#    with at most one request in flight per connection; requests with a rejected nonce keep their place in the queue
+#    in addition the same reads (method,uri,sorted params) aren't added multiple times to the queue,
+#    but the original request's result is shared with the new request (hiding abstraction from the user)
 # - PriorityBitcoinDeAPI orders the queue by a priority
+# - RequestQueue holds the queued requests, the waiting ones in a heap, and indexes them by RequestKey for the dedup
 #
 # - BtcdeAPIProtocol is used in 'response.deliverBody(...)' to parse the request's response
 # - StringProducer handles body-generation for POST-Requests
 
 # TODO 03.06.2017: Track Down error handling for Protocol JSON error
 
+# Seconds a response of the public (GET) calls is served from the cache, trading calls are never cached
+CACHE_TTLS = {'showRates':60,'showOrderbookCompact':10,'showOrderbook':10,'showPublicTradeHistory':10}
+# Fields of a result that describe the request that fetched it, they are not stored with cached responses
+REQUEST_FIELDS = ('nonce','reqID','attempts')
+
 class BitcoinDeAPI(object):
-    def __init__(self,reactor,api_key,api_secret):
+    def __init__(self,reactor,api_key,api_secret,connections=3):
         # Bitcoin.de API URI
-        apihost = 'https://api.bitcoin.de'
+        self.host = 'api.bitcoin.de'
+        apihost = 'https://' + self.host
         apiversion = 'v1'
         orderuri = apihost + '/' + apiversion + '/' + 'orders'
         tradeuri = apihost + '/' + apiversion + '/' + 'trades'
         accounturi = apihost + '/' + apiversion + '/' + 'account'
         # set initial nonce
-        self.nonce = int(time.time())
+        self.nonces = NonceSequencer(int(time.time()))
 
         self.reactor = reactor
-        pool = HTTPConnectionPool(reactor)		# Actually reusing the connection leads to correct credits
-        pool.maxPersistentPerHost = 1
+        self.connections = connections
+        self.pool = HTTPConnectionPool(reactor)		# Actually reusing the connection leads to correct credits
+        self.pool.maxPersistentPerHost = connections
         self.contextFactory = WebClientContextFactory()
-        self.agent = Agent(self.reactor, self.contextFactory,pool=pool)
+        self.agent = SigningAgent(self.reactor, self.contextFactory,pool=self.pool)
+        self.cache = ResponseCache(self.reactor.seconds,CACHE_TTLS)	# None disables the cache
 
         self.api_key = api_key
         self.api_secret = api_secret
@@ -122,6 +137,8 @@ class BitcoinDeAPI(object):
             priority = kwargs.get('priority',1)
             if 'priority' in kwargs.keys():
                 del kwargs["priority"]
+            if self.cache is not None and method == 'GET' and call in self.cache.ttls:
+                return self.CachedAPIRequest(call,method,kwargs,uri,credits,priority)
             return self.EnqueAPIRequest(method,kwargs,uri,credits,priority)
         else:
             # Unknown request
@@ -132,10 +149,38 @@ class BitcoinDeAPI(object):
     def EnqueAPIRequest(self,method,params,uri,credits,priority):
         return self.APIConnect(method,params,uri)
 
+    def RequestKey(self,method,uri,params):
+        """Canonical key of a read: the request as it goes on the wire (method,uri,sorted params).
+            Only GET requests are shared, others (trading calls) get None and never merge"""
+        if method != 'GET':
+            return None
+        return (method,uri,tuple(sorted((str(k),str(v)) for k,v in params.items())))
+
+    def CachedAPIRequest(self,call,method,params,uri,credits,priority):
+        """Serve a read from the cache; a stale entry is served as well while it is refreshed in the background.
+            Misses (and unique=True) are requested and stored"""
+        cache = self.cache
+        key = self.RequestKey(method,uri,dict((k,v) for k,v in params.items() if k != "unique"))
+        if params.get("unique",False) != True:
+            result,fresh = cache.Get(key,credits)
+            if result is not None:
+                if not fresh:
+                    if cache.Refresh(key):
+                        d = self.EnqueAPIRequest(method,dict(params),uri,credits,priority)
+                        d.addBoth(cache.Store,key,call)
+                        d.addErrback(lambda failure : None)
+                    else:	# Joins the refresh already under way
+                        cache.credits_saved += credits
+                return succeed(result)
+        d = self.EnqueAPIRequest(method,params,uri,credits,priority)
+        d.addCallback(cache.Store,key,call)
+        return d
+
     # noinspection Annotator
     def APIConnect(self,method,params,uri,eid=None):
         """Encapsulates all the API encoding, starts the HTTP request, returns deferred
             eid is used to pass Data along the chain to be used later
+            The nonce is allocated and signed once the request's connection is ready, right before it is written
         """
         encoded_string = ''
         if params:
@@ -145,43 +190,44 @@ class BitcoinDeAPI(object):
             url = uri + '?' + encoded_string
         else:
             url = uri
-        self.nonce += 1
 
         if method == 'POST':
             md5_encoded_query_string = md5(encoded_string).hexdigest()
         else:
             md5_encoded_query_string = md5('').hexdigest()
 
-        hmac_data = method + '#' + url + '#' + self.api_key + '#' + str(self.nonce) + '#' + md5_encoded_query_string
-        hmac_signed = hmac_new(self.api_secret,digestmod=sha256, msg=hmac_data).hexdigest()
-
         header = {'content-type':['application/x-www-form-urlencoded;charset=utf-8']}
         header[b"X-API-KEY"] = [self.api_key]
-        header[b"X-API-NONCE"] = [b"%d"%self.nonce]
-        header[b"X-API-SIGNATURE"] =  [hmac_signed]
 
         h = Headers({})
         for k,v in header.items():
             h.setRawHeaders(k,v)
 
+        def Sign(headers):
+            nonce = self.nonces.Next()
+            hmac_data = method + '#' + url + '#' + self.api_key + '#' + str(nonce) + '#' + md5_encoded_query_string
+            hmac_signed = hmac_new(self.api_secret,digestmod=sha256, msg=hmac_data).hexdigest()
+            headers.setRawHeaders(b"X-API-NONCE",[b"%d"%nonce])
+            headers.setRawHeaders(b"X-API-SIGNATURE",[hmac_signed])
+
         bodyProducer = None
         if method == 'POST':
             bodyProducer = StringProducer(encoded_string)
 
-        d = self.agent.request(method,url,headers=h,bodyProducer=bodyProducer)
+        d = self.agent.request(method,url,headers=h,bodyProducer=bodyProducer,signer=Sign)
         d.addCallback(self.APIResponse,eid=eid)
-
-        def Error(result):
-            print("API-Connect-Error", result)
-
-        d.addErrback(Error)
+        d.addErrback(self.APIConnectError,eid=eid)
         return d
 
+    def APIConnectError(self,failure,eid):
+        """Errback of requests that got no response (refused connection, DNS or TLS failure, ResponseNeverReceived)"""
+        print("API-Connect-Error", failure)
+
     def APIResponse(self,response,eid):
         """Process Response.header and choose treatment of the body"""
         finished = Deferred()
         response.deliverBody(BtcdeAPIProtocol(finished))
-        header = {"code":response.code,"phrase":response.phrase}
+        header = {"code":response.code,"phrase":response.phrase,"nonce":self.ResponseNonce(response)}
 
         if response.code == 200 or response.code == 201:
             finished.addCallback(self.DequeueAPIRequest,eid=eid,header=header)
@@ -228,40 +274,165 @@ class BitcoinDeAPI(object):
     def HandleAPISuccess(self,header):
         pass
 
+    def ResponseNonce(self,response):
+        """The nonce the response's request was signed with"""
+        nonce = response.request.headers.getRawHeaders(b"X-API-NONCE",[None])[0]
+        if nonce is None:
+            raise ValueError("Request was sent without a nonce: %s" % response.request.uri)
+        return int(nonce)
+
     def ResetNonce(self):
-        """Reset the nonce to the 'default' value, which is just the current unix-time and should suffice as at most 0.5Hz query frequency are sustainable"""
-        self.nonce = int(time.time())
+        """Advance the nonce to the 'default' value, which is just the current unix-time, never going back"""
+        self.nonces.last = max(self.nonces.last,int(time.time()))
 
 class BitcoinDeAPINonce(BitcoinDeAPI):
     """Adds Nonce Error Handling."""
-    def __init__(self,reactor,api_key,api_secret):
-        super(BitcoinDeAPINonce,self).__init__(reactor,api_key,api_secret)
-
-        self.successful_nonce = 0	# Counts successfull Nonces
+    def __init__(self,reactor,api_key,api_secret,connections=3):
+        super(BitcoinDeAPINonce,self).__init__(reactor,api_key,api_secret,connections)
 
     def HandleAPIError(self,header):
         code,message = header["errcode"],header["errmessage"]
         if code == 4:	# Invalid Nonce
-            self.InvalidNonce()
+            self.InvalidNonce(header.get("nonce",None))
 
     def HandleAPISuccess(self,header):
-        self.SuccessfulNonce()
+        self.SuccessfulNonce(header.get("nonce",None))
+
+    def SuccessfulNonce(self,nonce):
+        if nonce is not None:
+            self.nonces.Accepted(nonce)
+
+    def InvalidNonce(self,nonce):
+        if nonce is not None:
+            self.nonces.Rejected(nonce)
+
+class NonceSequencer(object):
+    """Allocates strictly increasing nonces at signing time. A rejected nonce (error 4) was either overtaken by a later
+    one that reached the API first, then signing the retry with the next nonce suffices, or the API has seen nonces
+    ahead of the sequence (another client, a restart): then the sequence jumps forward, by twice as much each time."""
+    def __init__(self,start,step=16):
+        self.last = start	# Last allocated nonce
+        self.accepted = 0	# Highest nonce accepted by the API
+        self.step = step
+        self.jump = step
+        self.rejected = 0
+        self.jumps = 0
+
+    def Next(self):
+        self.last += 1
+        return self.last
+
+    def Accepted(self,nonce):
+        if nonce > self.accepted:
+            self.accepted = nonce
+        self.jump = self.step
+
+    def Rejected(self,nonce):
+        self.rejected += 1
+        if nonce < self.accepted:
+            return	# Overtaken, the retry is signed with the next nonce anyway
+        self.last = max(self.last,self.accepted)+self.jump
+        self.jump *= 2
+        self.jumps += 1
+
+class SigningAgent(Agent):
+    """Agent whose request takes the signer explicitly: signer(headers) runs once the request's connection is ready,
+    just before the request is written, on the headers it is written with. Nonces go out in the order they are
+    allocated, whichever connection is faster to open"""
+    def request(self,method,uri,headers=None,bodyProducer=None,signer=None):
+        if signer is None:
+            return Agent.request(self,method,uri,headers,bodyProducer)
+        parsedURI = URI.fromBytes(uri)
+        try:
+            endpoint = self._getEndpoint(parsedURI)
+        except Exception:	# Unsupported scheme, no TLS support: fail the request, like a refused connection
+            return fail()
+        headers = headers.copy() if headers is not None else Headers()	# Signed below, the caller's stay untouched
+        if not headers.hasHeader(b"host"):
+            headers.addRawHeader(b"host",self._computeHostValue(parsedURI.scheme,parsedURI.host,parsedURI.port))
+        d = self._pool.getConnection((parsedURI.scheme,parsedURI.host,parsedURI.port),endpoint)
+        def Connected(connection):
+            signer(headers)
+            if not headers.hasHeader(b"X-API-NONCE") or not headers.hasHeader(b"X-API-SIGNATURE"):
+                raise ValueError("Signer did not sign the request: %s" % uri)
+            return connection.request(Request._construct(method,parsedURI.originForm,headers,bodyProducer,
+                                                          persistent=self._pool.persistent,parsedURI=parsedURI))
+        d.addCallback(Connected)
+        return d
 
-    def SuccessfulNonce(self):
-        """ Count up to 5 successive valid nonces"""
-        self.successful_nonce = max(min(4,self.successful_nonce+1),0)
+class ResponseCache(object):
+    """Responses by RequestKey, for the calls listed in ttls (call -> seconds). Least recently used entries are evicted
+    beyond max_bytes (size of the JSON). With stale > 0, entries up to stale seconds past their TTL are still served
+    while they are refreshed."""
+    def __init__(self,clock,ttls,max_bytes=4*1024*1024,stale=0.):
+        self.clock = clock
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.stale = stale
+        self.entries = OrderedDict()	# key -> [result,expires,size,refreshing], least recently used first
+        self.bytes = 0
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.credits_saved = 0
+
+    def Get(self,key,credits):
+        """Return (copy of the result,fresh), (None,False) on a miss. Only fresh hits count as credits saved, a stale
+            hit may start a refresh that spends them"""
+        entry = self.entries.pop(key,None)
+        if entry is not None:
+            late = self.clock()-entry[1]	# Seconds past the TTL
+            if late <= self.stale:
+                self.entries[key] = entry	# Most recently used
+                if late <= 0:
+                    self.hits += 1
+                    self.credits_saved += credits
+                else:
+                    self.stale_hits += 1
+                return deepcopy(entry[0]),late <= 0
+            self.bytes -= entry[2]
+        self.misses += 1
+        return None,False
+
+    def Refresh(self,key):
+        """Mark an entry as being refreshed, returns False if it already is"""
+        entry = self.entries.get(key,None)
+        if entry is None or entry[3]:
+            return False
+        entry[3] = True
+        return True
+
+    def Store(self,result,key,call):
+        """Callback: store successful results without the REQUEST_FIELDS, pass the result on"""
+        if isinstance(result,dict) and result.get("code",None) in (200,201):
+            stored = deepcopy(dict((k,v) for k,v in result.items() if k not in REQUEST_FIELDS))
+            size = len(dumps(stored))
+            old = self.entries.pop(key,None)
+            if old is not None:
+                self.bytes -= old[2]
+            if size <= self.max_bytes:
+                self.entries[key] = [stored,self.clock()+self.ttls[call],size,False]
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    _,entry = self.entries.popitem(last=False)
+                    self.bytes -= entry[2]
+                    self.evictions += 1
+        elif key in self.entries:
+            self.entries[key][3] = False	# Failed refresh, the next stale hit retries
+        return result
+
+    def Stats(self):
+        return {"hits":self.hits,"stale_hits":self.stale_hits,"misses":self.misses,"credits_saved":self.credits_saved,
+                "entries":len(self.entries),"bytes":self.bytes,"evictions":self.evictions}
 
-    def InvalidNonce(self):
-        """Decrease by one for every invalid nonce, if negative: reset"""
-        self.successful_nonce -= 1
-        if self.successful_nonce < 0:
-            self.ResetNonce()
 
 class QueuedAPIRequest(object):
     """Queued API Request to be stored till it's processed"""
-    def __init__(self,eid,rhash,method,uri,params,credits,deferred,priority):
+    def __init__(self,eid,key,method,uri,params,credits,deferred,priority):
         self.eid = eid
-        self.rhash = rhash
+        self.key = key	# RequestKey, None if the request must not be shared
         self.method=method
         self.uri=uri
         self.params=params
@@ -279,104 +450,193 @@ class QueuedAPIRequest(object):
         self.deferreds.append(deferred)
 
     def DeliverResult(self,result):
+        """Every waiting deferred gets a result of its own, copied before any callback can modify it"""
         result["attempts"] = self.attempts
-        for d in self.deferreds:
-            d.callback(result)
+        results = [result]+[deepcopy(result) for d in self.deferreds[1:]]
+        for d,r in zip(self.deferreds,results):
+            d.callback(r)
         self.done = 1
 
 
+class RequestQueue(object):
+    """Queued requests by id; the waiting (not issued) ones in a heap ordered by order(request), indexed by key.
+    Heap entries of deleted requests are skipped lazily."""
+    def __init__(self,order):
+        self.order = order
+        self.requests = {}	# eid -> QueuedAPIRequest
+        self.keys = {}	# RequestKey -> eid, the request that identical reads join
+        self.heap = []	# (order,eid) of the waiting requests
+        self.credits = 0	# Sum of the credits of all queued requests
+
+    def Add(self,req):
+        self.requests[req.eid] = req
+        if req.key is not None:
+            self.keys[req.key] = req.eid
+        self.credits += req.credits
+        self.Push(req.eid)
+
+    def Push(self,eid):
+        """(Re)enqueue a request as waiting"""
+        heappush(self.heap,(self.order(self.requests[eid]),eid))
+
+    def Next(self):
+        """Return the first waiting request, without removing it from the heap"""
+        heap = self.heap
+        while len(heap) > 0:
+            req = self.requests.get(heap[0][1],None)
+            if req is not None:
+                return req
+            heappop(heap)
+        return None
+
+    def Pop(self):
+        req = self.Next()
+        if req is not None:
+            heappop(self.heap)
+        return req
+
+    def Find(self,key):
+        """Return the queued (waiting or issued) request with the same key"""
+        eid = self.keys.get(key,None)
+        if eid is None:
+            return None
+        return self.requests[eid]
+
+    def __delitem__(self,eid):
+        req = self.requests.pop(eid)
+        if req.key is not None and self.keys.get(req.key,None) == eid:
+            del self.keys[req.key]
+        self.credits -= req.credits
+
+    def __getitem__(self,eid):
+        return self.requests[eid]
+
+    def __contains__(self,eid):
+        return eid in self.requests
+
+    def __len__(self):
+        return len(self.requests)
+
+    def items(self):
+        return sorted(self.requests.items(),key=lambda x : self.order(x[1]))
+
+    def values(self):
+        return self.requests.values()
+
+
+class CreditBucket(object):
+    """Token bucket model of the API credits: refills at rate credits per second up to capacity (the maximum seen).
+    The level drops by the credits of every issued request and is synchronised whenever the API reports its credits."""
+    def __init__(self,clock,rate=1.,capacity=8,level=5):
+        self.clock = clock	# Callable returning the current time
+        self.rate = rate
+        self.capacity = capacity
+        self.level = level
+        self.updated = clock()
+
+    def Level(self):
+        return min(self.capacity,self.level+(self.clock()-self.updated)*self.rate)
+
+    def Take(self,credits):
+        self.level = self.Level()-credits
+        self.updated = self.clock()
+
+    def Sync(self,credits,inflight=0):
+        """Set the level to the credits reported by the API, less the credits of requests still in flight"""
+        if credits > self.capacity:
+            self.capacity = credits
+        self.level = credits-inflight
+        self.updated = self.clock()
+
+    def Hold(self,seconds):
+        """Empty the bucket for the given number of seconds (Retry-After, the API's own account of its credits)"""
+        self.level = -seconds*self.rate
+        self.updated = self.clock()
+
+    def Wait(self,credits):
+        """Seconds until the bucket holds the given number of credits"""
+        return max(0.,(credits-self.Level())/self.rate)
+
+
 class QueuedBitcoinDeAPI(BitcoinDeAPINonce):
     """Implements a Queue that holds requests and manages credits"""
-    def __init__(self,reactor,api_key,api_secret):
-        super(QueuedBitcoinDeAPI,self).__init__(reactor,api_key,api_secret)
+    def __init__(self,reactor,api_key,api_secret,connections=3):
+        super(QueuedBitcoinDeAPI,self).__init__(reactor,api_key,api_secret,connections)
 
         self.requestID = 0
-        self.queue = {}
+        self.queue = RequestQueue(self.Order)
         self.pending = {}
         # Store the Reshedule Handle
-        self.retrycall = self.reactor.callLater(.1,self.IssueNext)	# Dummy call, delayed start at .1
+        self.retrycall = None
 
         # Credits
-        self.wait_for_credits = 0
-        self.lasttime = time.time()
-        self.lastcredits = 5
-        self.retryperiode = 3
-        self.max_seen = 8
-
+        self.credits = CreditBucket(self.reactor.seconds)
+        self.credit_reserve = 2	# Kept back to absorb inaccuracies of the model
+        self.max_inflight = connections	# One request in flight per connection, nonces are sequenced at signing time
         self.credits_spent = 0
 
-        # Hack to make CalcHash create unique values on demand
-        self.unique_salt = 0
-
-    def CalcHash(self,method,uri,params):
-        """if unique=True is passed as param, an additional salt is added	"""
-        h = 0
-        for p in params.values():
-            h += hash(p)
-        unique = params.pop("unique",False)
-        if unique == True:
-            self.unique_salt = (self.unique_salt+59999)%60013
-            h += self.unique_salt
-        ha = hash(method)+hash(uri)+h
-        return ha
-
-    def SameHashInQueue(self,h):
-        """Return an already queued Request if it has similar hash to the requested one """
-        rk,rreq = -1,None
-        for k,req in self.queue.items():
-            if req.rhash == h:
-                rk,rreq = k,req
-                break
-        return rk,rreq
+    def SameRequestInQueue(self,key):
+        """Return an already queued (or pending) Request with the same key"""
+        if key is None:
+            return -1,None
+        req = self.queue.Find(key)
+        if req is None:
+            return -1,None
+        return req.eid,req
+
+    def Order(self,req):
+        """Sort key of the queue, first in first out"""
+        return (0,req.eid)
 
     def Queue(self):
         return self.queue.items()
 
+    @property
+    def max_seen(self):
+        return self.credits.capacity
+
     def IssueNext(self):
-    #	print "IssueNext",len(self.queue),len(self.pending)
-        self.wait_for_credits = 0
-#		dt = 0.32	# Explicit pause inbetween two back to back request to avoid bad nonces
-#		dt = 0.54
-        dt = 0.4
-        if self.EnoughCreditsAvailable(3):
-            for k,req in self.Queue():
-                if k not in self.pending.keys():
-                    if req.attempts < 10:
-                        self.APIConnect(req.method,req.params,req.uri,k) # Chaining of APIResponse is done in this function, so returned deferred is not used.
-                        self.pending[k] = req.credits
-                        self.credits_spent += req.credits
-                        req.Send()
-                    else:
-                        req.DeliverResult({"error":"too many unsuccesful attempts","attempts":req.attempts})
-                        self.DeleteRequest(k)
-                    break
-        else:
-            dt = 2
-        if len(self.queue) > len(self.pending):	# (double counting in queue and pending)
-            # Schedule Next Issue, either back to back or when enough credits should be available
-            self.ScheduleNextIssue(dt)
-
-    def ScheduleNextIssue(self,dt=None):
-        """Is called from IssueNext, APIRequest and whenever Timing has to be updated (due to tight credits) """
-        if dt== None:
-            dt = 0.0
-        if dt > 2:
-            self.lastcredits = -dt-1
-            self.lasttime = time.time()
-            if self.wait_for_credits == 1 or self.retrycall.active():
+        """Issue queued requests while credits and max_inflight allow, then sleep until the next one is affordable"""
+        while len(self.pending) < self.max_inflight:
+            req = self.queue.Next()
+            if req is None:
+                break
+            k = req.eid
+            if req.attempts >= 10:
+                self.queue.Pop()
+                req.DeliverResult({"error":"too many unsuccesful attempts","attempts":req.attempts})
+                self.DeleteRequest(k)
+                continue
+            wait = self.credits.Wait(req.credits+self.credit_reserve)
+            if wait > 0:
+                self.ScheduleNextIssue(wait)
+                break
+            self.queue.Pop()
+            self.pending[k] = req.credits	# Before APIConnect, whose errback may run right away
+            self.credits.Take(req.credits)
+            self.credits_spent += req.credits
+            req.Send()
+            # Chaining of APIResponse is done in this function, so returned deferred is not used.
+            self.APIConnect(req.method,req.params,req.uri,k)
+
+    def ScheduleNextIssue(self,dt=0.):
+        """Run IssueNext in dt seconds, unless it is already scheduled to run earlier.
+            Is called from IssueNext and whenever the queue or the credits change"""
+        if self.retrycall is not None and self.retrycall.active():
+            if self.retrycall.getTime() > self.reactor.seconds()+dt:
                 self.retrycall.reset(dt)
-            else:
-                self.retrycall = self.reactor.callLater(dt,self.IssueNext)
         else:
-            if self.wait_for_credits == 0:
-                if self.retrycall.active():
-                    self.retrycall.reset(dt)
-                else:
-                    self.retrycall = self.reactor.callLater(dt,self.IssueNext)
+            self.retrycall = self.reactor.callLater(dt,self.IssueNext)
+
+    def APIConnectError(self,failure,eid):
+        """Free the request's slot in pending and retry it, the retry counts towards the attempts limit"""
+        super(QueuedBitcoinDeAPI,self).APIConnectError(failure,eid)
+        self.Reenqueue(eid)
 
     def Reenqueue(self,eid):
-        if eid in self.pending.keys():
+        if eid in self.pending:
             del self.pending[eid]
+            self.queue.Push(eid)
         self.ScheduleNextIssue()
 
     def DeleteRequest(self,eid):
@@ -385,33 +645,28 @@ class QueuedBitcoinDeAPI(BitcoinDeAPINonce):
             del self.pending[eid]
 
     def CreditsAvailable(self):
-        ct = time.time()
-        dt = ct-self.lasttime
-        return min(self.max_seen,self.lastcredits+dt)-sum(self.pending.values())
+        return self.credits.Level()
 
     def EnoughCreditsAvailable(self,credits):
-        available = self.CreditsAvailable()
-    #	print "inflight:",sum(self.pending.values()),"credits",available
-        if available > 2+credits:
-            return True
-        else:
-            return False
+        return self.credits.Wait(credits+self.credit_reserve) == 0
 
     def QueueCreditsAvailable(self):
         """ Returns a value reflecting the number of credits available with regard to enqueued requests"""
-        queuecredits = [x.credits for x in self.queue.values()]
-        return max(len(self.queue),self.CreditsAvailable()-sum(queuecredits))
+        return max(len(self.queue),self.CreditsAvailable()-self.queue.credits)
 
     def EnqueAPIRequest(self,method,params,uri,credits,priority):
         finished = Deferred()
 
-        h = self.CalcHash(method,uri,params)
-        samereqID,samereq = self.SameHashInQueue(h)	# Return same request if already enqueued or pending
+        unique = params.pop("unique",False)	# unique=True issues a request of its own, later reads may join it
+        key = self.RequestKey(method,uri,params)
+        samereqID,samereq = -1,None
+        if unique != True:
+            samereqID,samereq = self.SameRequestInQueue(key)	# Return same request if already enqueued or pending
         if samereqID == -1:	# unique request
             eid = self.requestID
             self.requestID += 1
-            request = QueuedAPIRequest(eid,h,method,uri,params,credits,finished,priority)	# Create the Request-object
-            self.queue[eid] = request
+            request = QueuedAPIRequest(eid,key,method,uri,params,credits,finished,priority)	# Create the Request-object
+            self.queue.Add(request)
 
         else:	# Request is already running
             eid = samereqID
@@ -431,32 +686,39 @@ class QueuedBitcoinDeAPI(BitcoinDeAPINonce):
 
         response.deliverBody(BtcdeAPIProtocol(finished))
         req = self.queue[eid]
-        header = {"code":response.code,"phrase":response.phrase,"call":req.method+":"+req.uri,"reqID":eid}
+        header = {"code":response.code,"phrase":response.phrase,"call":req.method+":"+req.uri,"reqID":eid,
+                  "nonce":self.ResponseNonce(response)}
         if response.code == 200 or response.code == 201:
             finished.addCallback(self.DequeueAPIRequest,eid=eid,header=header)
 
         else:
-            self.lastcredits -= self.pending[eid]
+            # The credits of a failed request stay spent
             if response.code == 429 or response.code == 403:	# 403 might need some extra handling
                 if response.code == 403:
                     print("\n" + header + "\n")
                 retry = int(response.headers.getRawHeaders("Retry-After",[0])[0])
                 header["retry"] = retry
+                self.credits.Hold(retry)
                 self.Reenqueue(eid)
-                self.ScheduleNextIssue(retry+3)
                 finished.addCallback(self.DequeueAPIErrors,eid=eid,header=header)
 
             else:
                 d = finished.addCallback(self.DequeueAPIErrors,eid=eid,header=header)
                 if response.code == 400:
                     # TODO: response 400 can still have error codes like 27 (bad params, which should not lead to reenqueue)
-                    self.Reenqueue(eid)
-                    self.ScheduleNextIssue()
+                    # Reenqueued requests keep their place (Order) in the queue: a rejected nonce (error 4) is retried
+                    # ahead of the requests queued after it. Only once the body is parsed, so the NonceSequencer has
+                    # seen the rejection before the retry is signed
+                    def Retry(header):
+                        self.Reenqueue(eid)
+                        return header
+                    d.addCallback(Retry)
                 else:
                     # Every other error than 400 is not retried!
                     d.addCallback(req.DeliverResult)	# Don't know if this is a problem, that req.DeliverResult is called, but the request is removed from the queue
                     del self.pending[eid]
                     del self.queue[eid]
+                    self.ScheduleNextIssue()
 
 
 
@@ -468,24 +730,18 @@ class QueuedBitcoinDeAPI(BitcoinDeAPINonce):
         response.update(header)
         response["attempts"] = req.attempts
 
-        credits = response.get("credits",0)
-        if credits > self.max_seen:
-            self.max_seen = credits
-        self.lasttime = time.time()
-        self.lastcredits = credits
-
         self.queue[eid].DeliverResult(response)
         del self.pending[eid]
         del self.queue[eid]
 
-        self.HandleAPISuccess(header)	# Handle success [successful_nonce counter]
+        credits = response.get("credits",None)
+        if credits is not None:
+            self.credits.Sync(credits,sum(self.pending.values()))
+        self.ScheduleNextIssue()	# Credits changed, recompute when the next request is affordable
 
-        return response
+        self.HandleAPISuccess(header)	# Handle success [accepted nonce]
 
-    def HandleAPIError(self,header):
-        code,message = header["errcode"],header["errmessage"]
-        if code == 4:	# Invalid Nonce
-            self.InvalidNonce()
+        return response
 
     def APIRequestPages(self,call,pages,**kwargs):
         """Request a certain number of pages
@@ -494,12 +750,16 @@ class QueuedBitcoinDeAPI(BitcoinDeAPINonce):
         pass
 
     def Status(self):
-        return {"total_spent":self.credits_spent,"max":self.max_seen,"hot":self.QueueCreditsAvailable(),"avail":self.CreditsAvailable()}
+        status = {"total_spent":self.credits_spent,"max":self.max_seen,"hot":self.QueueCreditsAvailable(),
+                  "avail":self.CreditsAvailable()}
+        if self.cache is not None:
+            status["cache"] = self.cache.Stats()
+        return status
 
 class PriorityBitcoinDeAPI(QueuedBitcoinDeAPI):
-    def Queue(self):
-        q = sorted(self.queue.items(),key=lambda x : (-x[1].priority,x[1].eid))
-        return q
+    def Order(self,req):
+        """Higher priority first, first in first out within a priority"""
+        return (-req.priority,req.eid)
 
 class StringProducer(object):
     implements(IBodyProducer)
@@ -3,8 +3,11 @@
 from __future__ import annotations  # enable code compatibility
 
 import argparse
+import os
+import threading
 from time import time
 
+import msgpack
 import zmq
 
 from twisted.internet import endpoints, reactor  # unfortunately reactor is needed in ClientIo0916Protocol
@@ -18,15 +21,28 @@ from bitcoinde.eventhandlers import \
     BitcoinWebSocketSkn, \
     BitcoinWebSocketSpr
 
+from bitcoinde import binary
 from bitcoinde.events import Event, BitcoinWebSocketEventHandler, EventSink
+from bitcoinde.statistics import LAG_BUCKETS_MS, SourceStatistics
+from bitcoinde.capture import CaptureWriter
+from bitcoinde.dispatch import BLOCK, DROP_NEWEST, DROP_OLDEST, QueuedEventSink, ReactorEventSink
 from bitcoinde.factories import BitcoinWSSourceV09, BitcoinWSSourceV20
+from bitcoinde.journal import EventJournal
+from bitcoinde.messages import pack_batch
+from bitcoinde.orderbook import OrderBook, SNAPSHOT_FIELDS
+from bitcoinde.reconcile import OrderBookReconciler
+from bitcoinde.rest import BitcoinDeRestClient
+from bitcoinde.schema import SchemaError
+from bitcoinde.supervisor import SourceSupervisor
 
 
 class BitcoinWebSocketMulti(object):
     """ClientService ensures restart after connection is lost."""
 
-    def __init__(self, servers=[1, 3, 4]):
+    def __init__(self, servers=[1, 3, 4], retention_seconds=60.):
         self.sinks = []  # a list of event sinks
+        self.recorder = None  # records the raw traffic of all sources, see capture_to
+        self.sequence = 0  # sequence number of the last delivered event
         self.servers = {1: ("ws", BitcoinWSSourceV09,),
                         2: ("ws1", BitcoinWSSourceV09,),
                         3: ("ws2", BitcoinWSSourceV20,),
@@ -36,22 +52,43 @@ class BitcoinWebSocketMulti(object):
 
         self.connService = {}  # a backing field used to store client-services
 
-        self.event_handlers = {"remove_order": BitcoinWebSocketRemoveOrder(),
-                               "add_order": BitcoinWebSocketAddOrder(),
-                               "skn": BitcoinWebSocketSkn(),
-                               "spr": BitcoinWebSocketSpr(),
-                               "refresh_express_option": BitcoinWebSocketRefreshExpressOption()}
+        # events are kept for deduplication for retention_seconds
+        self.event_handlers = {"remove_order": BitcoinWebSocketRemoveOrder(retention_seconds=retention_seconds),
+                               "add_order": BitcoinWebSocketAddOrder(retention_seconds=retention_seconds),
+                               "skn": BitcoinWebSocketSkn(retention_seconds=retention_seconds),
+                               "spr": BitcoinWebSocketSpr(retention_seconds=retention_seconds),
+                               "refresh_express_option":
+                                   BitcoinWebSocketRefreshExpressOption(retention_seconds=retention_seconds)}
 
         for sid in servers:
-            addr, factory_creator, = self.servers.get(sid, (None, None,))
-            if addr is not None:
-                context_factory = optionsForClientTLS(u'%s.bitcoin.de' % addr, None)
-                endpoint = endpoints.SSL4ClientEndpoint(reactor, '%s.bitcoin.de' % addr, 443, context_factory)
-                factory = factory_creator(sid, self)
-                self.sources[sid] = factory  # Reference to self is passed here, receive_event is called by source
-                client_service = ClientService(endpoint, factory)
-                self.connService[sid] = client_service
-                client_service.startService()
+            self.connect(sid)
+
+    def connect(self, sid: int):
+        """Connects to the websocket endpoint with the given server id; ClientService keeps reconnecting."""
+        addr, factory_creator, = self.servers.get(sid, (None, None,))
+        if addr is not None and sid not in self.connService:
+            context_factory = optionsForClientTLS(u'%s.bitcoin.de' % addr, None)
+            endpoint = endpoints.SSL4ClientEndpoint(reactor, '%s.bitcoin.de' % addr, 443, context_factory)
+            factory = factory_creator(sid, self)
+            self.sources[sid] = factory  # Reference to self is passed here, receive_event is called by source
+            for event_handler in self.event_handlers.values():
+                event_handler.statistics.register(sid)  # misses are counted even if the source never delivers
+            client_service = ClientService(endpoint, factory)
+            self.connService[sid] = client_service
+            client_service.startService()
+
+    def disconnect(self, sid: int):
+        """Stops the client-service of the given server id and closes its connection."""
+        client_service = self.connService.pop(sid, None)
+        self.sources.pop(sid, None)
+        if client_service is not None:
+            client_service.stopService()
+
+    def capture_to(self, path: str) -> BitcoinWebSocketMulti:
+        """Records the raw websocket traffic of all sources to the given file, for bitcoinde.replay."""
+        self.recorder = CaptureWriter(path)
+        reactor.addSystemEventTrigger("before", "shutdown", self.recorder.close)
+        return self
 
     def get_event_handler(self, event_type: str) -> BitcoinWebSocketEventHandler:
         """Finds a handler for the specified type of event."""
@@ -64,59 +101,265 @@ class BitcoinWebSocketMulti(object):
         event_handler: BitcoinWebSocketEventHandler = self.get_event_handler(event_type)
         event: Event = None
         if event_handler is not None:
-            event = event_handler.process_event(data, src, unix_time_seconds)
+            try:
+                event = event_handler.process_event(data, src, unix_time_seconds)
+            except SchemaError as e:
+                print("malformed event from", src, e)
         else:
             print("no Event stream for", src, event_type, data, current_unix_time_seconds - unix_time_seconds)
 
         if event is not None:
             self.deliver(event)
 
-    def write_to(self, sink: EventSink) -> BitcoinWebSocketMulti:
-        """Registers the given event sink with the current multi-source instance."""
-        self.sinks.append(sink)
+    def receive_raw_event(self, event_type: str, raw: str, src: int, unix_time_seconds: float) -> bool:
+        """Pre-dedup stage called by an event-source before decoding the payload. Returns True if the event has
+        already been received from another source; only its arrival is recorded then."""
+        event_handler: BitcoinWebSocketEventHandler = self.get_event_handler(event_type)
+        if event_handler is None:
+            return False
+        return event_handler.process_raw_event(raw, src, unix_time_seconds)
+
+    def write_to(self, sink: EventSink, queue_size=10000, policy=BLOCK) -> BitcoinWebSocketMulti:
+        """Registers the given event sink with the current multi-source instance. Unless queue_size is 0, the sink
+        gets a bounded queue and a worker thread of its own; policy decides what happens if the queue is full
+        (BLOCK, DROP_OLDEST or DROP_NEWEST). Otherwise, events are delivered synchronously on the reactor. The sink is
+        closed before the reactor shuts down."""
+        if queue_size > 0:
+            wrapper = QueuedEventSink(sink, queue_size, policy)
+        else:
+            wrapper = ReactorEventSink(sink)
+        self.sinks.append(wrapper)
+        reactor.addSystemEventTrigger("before", "shutdown", wrapper.close)
         return self
 
     def deliver(self, event: Event):
-        """Pushes the given event to all registered sinks."""
+        """Stamps the given event with the next sequence number and pushes it to all registered sinks."""
+        self.sequence += 1
+        event.sequence = self.sequence
         for sink in self.sinks:  # type: EventSink
             sink.process_event(event)
 
-    def stats(self):
-        pass
+    def source_names(self) -> dict:
+        return dict((sid, addr) for sid, (addr, factory_creator,) in self.servers.items())
+
+    def stats(self, reset=False) -> dict:
+        """Returns cross-source arrival statistics, per event type and aggregated per source: the number of events
+        each source delivered first (win rate), how far it lagged behind the fastest source (histogram buckets are
+        given in milliseconds by lag_buckets_ms, the last one is open) and how many events it missed entirely."""
+        names = self.source_names()
+        totals, events = {}, 0
+        result = {"lag_buckets_ms": list(LAG_BUCKETS_MS), "events": {}, "sources": {}}
+        for event_type, event_handler in self.event_handlers.items():
+            statistics = event_handler.statistics
+            result["events"][event_type] = statistics.summary(names)
+            events += statistics.events
+            for sid, source_statistics in statistics.sources.items():
+                totals.setdefault(sid, SourceStatistics()).add(source_statistics)
+            if reset:
+                statistics.reset()
+        for sid, source_statistics in totals.items():
+            result["sources"][names.get(sid, sid)] = source_statistics.summary(events)
+        result["sinks"] = [sink.stats() for sink in self.sinks]
+        return result
 
 
 class ZeroMqEventProcessingSink(EventSink):
 
-    def __init__(self, port: int):
-        """Initializes a PUSH socket using the given port."""
+    def __init__(self, port: int, topics=False, batch_size=1, batch_delay=0.001, encoding="msgpack",
+                 schema_interval=10.):
+        """Initializes a PUSH socket using the given port. If topics is set, each event is sent as a multipart
+        message prefixed with a topic frame (<type>.<trading_pair>), so that subscribers can filter on the
+        publisher side; otherwise a single unprefixed frame is sent (compatibility mode).
+
+        If batch_size is greater than one, events (of the same topic) are grouped into a msgpack array, that is sent
+        once batch_size events are buffered, or batch_delay seconds after the first one.
+
+        encoding is the name of an Event encoding; with "binary", add and rm events are sent in the compact layout
+        of bitcoinde.binary, and its schema (version and code tables) is published every schema_interval seconds
+        (topic "schema.")."""
+        if encoding not in Event.encoders:
+            raise ValueError("Unknown encoding: %s" % encoding)
         self.port = port
+        self.topics = topics
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.batches = {}  # topic -> list of packed events
+        self.batch_deadline = None
+        self.encoding = encoding
+        self.schema_interval = schema_interval
+        self.schema_at = None  # time the schema is published next
 
         self.context = zmq.Context()
+        self.socket = None
+
+    def open(self):
+        """Creates the socket on the thread that delivers the events; ZeroMQ sockets must not be shared."""
+        self.socket = self.context.socket(zmq.PUB)
+        address = 'tcp://*:%s' % self.port
+        print('Binding pub-socket to address %s' % address)
+        self.socket.bind(address)
+        print("Running server on port: %s" % self.port)
+        if self.encoding == "binary":
+            self.schema_at = time()
+
+    @staticmethod
+    def topic(event: Event) -> bytes:
+        """Returns the topic of the given event, for instance b"add.btceur" (b"rm." if the pair is unknown)."""
+        trading_pair = ""
+        if isinstance(event.event_data, dict):
+            trading_pair = event.event_data.get("trading_pair", None) or ""
+        return ("%s.%s" % (event.event_type, trading_pair)).encode("utf8")
 
-        def create_pub_socket():
-            self.socket = self.context.socket(zmq.PUB)
-            address = 'tcp://*:%s' % port
-            print('Binding pub-socket to address %s' % address)
-            self.socket.bind(address)
-            print("Running server on port: %s" % port)
+    def process_event(self, event: Event):
+        """Sends the given event to a PUSH socket."""
+        packed = event.encode(self.encoding)
+        topic = self.topic(event) if self.topics else None
+        if self.batch_size > 1:
+            batch = self.batches.get(topic, None)
+            if batch is None:
+                batch = self.batches[topic] = []
+            batch.append(packed)
+            if len(batch) >= self.batch_size:
+                del self.batches[topic]
+                if len(self.batches) == 0:
+                    self.batch_deadline = None
+                self.send(topic, pack_batch(batch))
+            elif self.batch_deadline is None:
+                self.batch_deadline = time() + self.batch_delay
+        else:
+            self.send(topic, packed)
 
-        import threading
-        threading.Thread(target=create_pub_socket).start()
+    def send(self, topic: bytes, message: bytes):
+        if topic is not None:
+            self.socket.send_multipart([topic, message])
+        else:
+            self.socket.send(message, )
+
+    def deadline(self):
+        if self.schema_at is None or self.batch_deadline is not None and self.batch_deadline < self.schema_at:
+            return self.batch_deadline
+        return self.schema_at
+
+    def flush(self):
+        """Sends all buffered batches, and the schema if it is due."""
+        self.batch_deadline = None
+        batches, self.batches = self.batches, {}
+        for topic, batch in batches.items():
+            self.send(topic, pack_batch(batch))
+        if self.schema_at is not None and time() >= self.schema_at:
+            self.schema_at = time() + self.schema_interval
+            self.send(b"schema." if self.topics else None, msgpack.packb(binary.schema()))
+
+    def close(self):
+        self.flush()
+        self.socket.close()
+
+
+class ZeroMqSnapshotServer(EventSink):
+    """Maintains an order book from the delivered events and serves snapshots of it on a ZeroMQ ROUTER socket (for
+    REQ or DEALER clients). A request is an empty frame or a message-packed list of trading pairs; the reply is the
+    message-packed dict {"seq": sequence of the last event applied, "fields": SNAPSHOT_FIELDS, "books": ...}.
+    A late joiner subscribes first, requests a snapshot and then skips the published events up to seq.
+
+    On its own, the server builds its book from the delivered events only: it holds the orders added since startup,
+    orders that were open before are missing. Given an OrderBookReconciler, the server serves its book, which is
+    seeded from REST snapshots; the server has to be registered with queue_size=0 then, like the reconciler."""
+
+    def __init__(self, port: int, reconciler: OrderBookReconciler = None):
+        self.port = port
+        self.reconciler = reconciler
+        self.book = reconciler.book if reconciler is not None else OrderBook()
+        self.sequence = 0
+        self.lock = threading.Lock()  # the book is updated by the delivering thread and read by the server thread
+        if reconciler is not None:
+            reconciler.lock = self.lock
+        self.context = zmq.Context()
+        self.running = False
+        self.thread = None
+        self.requests = 0
+
+    def open(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name="snapshot-server")
+        self.thread.daemon = True
+        self.thread.start()
 
     def process_event(self, event: Event):
-        """Sends the given event to a PUSH socket."""
-        packed = event.pack()
-        self.socket.send(packed, )
+        with self.lock:
+            (self.reconciler if self.reconciler is not None else self.book).process_event(event)
+            self.sequence = event.sequence
+
+    def snapshot(self, trading_pairs=None) -> dict:
+        with self.lock:
+            return {"seq": self.sequence, "fields": list(SNAPSHOT_FIELDS),
+                    "books": self.book.snapshot(trading_pairs)}
+
+    def serve(self):
+        socket = self.context.socket(zmq.ROUTER)
+        address = 'tcp://*:%s' % self.port
+        print('Binding snapshot-socket to address %s' % address)
+        socket.bind(address)
+        while self.running:
+            if socket.poll(100) == 0:
+                continue
+            frames = socket.recv_multipart()
+            envelope, request = frames[:-1], frames[-1]  # identity (and the empty delimiter of REQ clients)
+            try:
+                trading_pairs = msgpack.unpackb(request, raw=False) if len(request) > 0 else None
+                reply = msgpack.packb(self.snapshot(trading_pairs))
+            except Exception as e:
+                reply = msgpack.packb({"error": str(e)})
+            socket.send_multipart(envelope + [reply])
+            self.requests += 1
+        socket.close()
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
 
 
 class BitcoinWebSocketApplicationOptions(object):
     """An interface for commandline arguments."""
     zmq_pub_socket_port: int  # the ZeroMQ SUB socket port to use.
+    topics: bool  # whether to prefix messages with a topic frame
+    batch_size: int  # maximum number of events per message
+    batch_delay: float  # maximum number of seconds an event is held back for batching
+    encoding: str  # msgpack or binary
+    journal: str  # directory of the event journal, or None
+    snapshot_port: int  # port of the ZeroMQ snapshot server, or None
+    capture: str  # file to record the raw websocket traffic to, or None
+    supervise: bool  # whether to manage the connected endpoints based on arrival statistics
+    queue_size: int  # maximum number of events queued for the sink, 0 delivers on the reactor thread
+    queue_policy: str  # what to do if the queue is full
+    reconcile: str  # comma-separated trading pairs to seed and resync from REST snapshots, or None
+    api_key: str  # bitcoin.de API key (read access), required by reconcile
+    api_secret: str
 
 
 def main(options: BitcoinWebSocketApplicationOptions):
     sources = BitcoinWebSocketMulti()
-    sources.write_to(ZeroMqEventProcessingSink(options.zmq_pub_socket_port))
+    sink = ZeroMqEventProcessingSink(options.zmq_pub_socket_port, options.topics, options.batch_size,
+                                     options.batch_delay, options.encoding)
+    sources.write_to(sink, options.queue_size, options.queue_policy)
+    reconciler = None
+    if options.reconcile is not None:
+        client = BitcoinDeRestClient(reactor, options.api_key, options.api_secret)
+        reconciler = OrderBookReconciler(client, options.reconcile.split(","))
+        reactor.callWhenRunning(reconciler.start)
+    if options.snapshot_port is not None:
+        if reconciler is not None:
+            sources.write_to(ZeroMqSnapshotServer(options.snapshot_port, reconciler), queue_size=0)
+        else:
+            sources.write_to(ZeroMqSnapshotServer(options.snapshot_port), options.queue_size)
+    elif reconciler is not None:
+        sources.write_to(reconciler, queue_size=0)
+    if options.capture is not None:
+        sources.capture_to(options.capture)
+    if options.journal is not None:
+        sources.write_to(EventJournal(options.journal, options.encoding), options.queue_size)
+    if options.supervise:
+        SourceSupervisor(sources).start()
 
     reactor.run()
 
@@ -128,5 +371,66 @@ if __name__ == '__main__':
                         dest="zmq_pub_socket_port",
                         help="Specifies the ZeroMQ SUb socket port to use.",
                         default=5634)
+    parser.add_argument("--topics",
+                        action="store_true",
+                        dest="topics",
+                        help="Prefixes each message with a topic frame (<type>.<trading_pair>).")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        dest="batch_size",
+                        help="Groups up to this number of events into one message (msgpack array).",
+                        default=1)
+    parser.add_argument("--batch-delay",
+                        type=float,
+                        dest="batch_delay",
+                        help="Maximum number of seconds an event is held back for batching.",
+                        default=0.001)
+    parser.add_argument("--encoding",
+                        choices=("msgpack", "binary"),
+                        dest="encoding",
+                        help="Sends add and rm events in a compact binary layout (see bitcoinde/binary.py).",
+                        default="msgpack")
+    parser.add_argument("--snapshot-port",
+                        type=int,
+                        dest="snapshot_port",
+                        help="Serves order book snapshots on a ZeroMQ ROUTER socket with the given port.",
+                        default=None)
+    parser.add_argument("--journal",
+                        dest="journal",
+                        help="Appends all events to a segmented journal in the given directory.",
+                        default=None)
+    parser.add_argument("--capture",
+                        dest="capture",
+                        help="Records the raw websocket traffic to the given file (see bitcoinde/replay.py).",
+                        default=None)
+    parser.add_argument("--supervise",
+                        action="store_true",
+                        dest="supervise",
+                        help="Demotes endpoints that never deliver events first and probes disabled ones.")
+    parser.add_argument("--queue-size",
+                        type=int,
+                        dest="queue_size",
+                        help="Maximum number of events queued per sink; 0 delivers on the reactor thread.",
+                        default=10000)
+    parser.add_argument("--queue-policy",
+                        choices=(BLOCK, DROP_OLDEST, DROP_NEWEST),
+                        dest="queue_policy",
+                        help="What to do with events if the queue is full.",
+                        default=BLOCK)
+    parser.add_argument("--reconcile",
+                        dest="reconcile",
+                        help="Seeds the order book of the snapshot server from REST snapshots of the given trading "
+                             "pairs (comma-separated) and resyncs it after gaps; requires --api-key and --api-secret.",
+                        default=None)
+    parser.add_argument("--api-key",
+                        dest="api_key",
+                        help="bitcoin.de API key, for --reconcile (default: $BITCOINDE_API_KEY).",
+                        default=os.environ.get("BITCOINDE_API_KEY"))
+    parser.add_argument("--api-secret",
+                        dest="api_secret",
+                        help="bitcoin.de API secret, for --reconcile (default: $BITCOINDE_API_SECRET).",
+                        default=os.environ.get("BITCOINDE_API_SECRET"))
     args: BitcoinWebSocketApplicationOptions = parser.parse_args()
+    if args.reconcile is not None and (args.api_key is None or args.api_secret is None):
+        parser.error("--reconcile requires --api-key and --api-secret")
     main(args)
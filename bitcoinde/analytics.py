@@ -0,0 +1,164 @@
+from bisect import bisect_left, bisect_right
+
+from bitcoinde.orderbook import OrderBook, OrderBookSide
+
+try:
+    import numpy
+except ImportError:  # bulk queries fall back to scalar ones
+    numpy = None
+
+
+class SideAnalytics(object):
+    """Answers depth and VWAP queries for one side of a book. Cumulative amount and notional (price * amount) are
+    kept as prefix sums over the levels in best-first order. A changed level only invalidates the sums from its
+    position on, and they are recomputed lazily, only as deep as a query needs. VWAP results are memoized per
+    amount and dropped when a level they may have consumed changes: a change at or above the deepest level any entry
+    has consumed starts a new memo generation in O(1), deeper changes keep the memo."""
+
+    def __init__(self, side: OrderBookSide, memo_size=1024):
+        self.side = side
+        self.cum_amount = []  # cum_amount[j]: amount of the j + 1 best levels
+        self.cum_notional = []
+        self.memo = {}  # amount -> (vwap, number of levels consumed, generation)
+        self.memo_size = memo_size
+        self.generation = 0  # entries of older generations are stale
+        self.memo_levels = 0  # number of levels consumed by the deepest entry of the current generation
+        self.arrays = None  # numpy copies of the prefix sums for bulk queries
+        side.watchers.append(self.level_changed)
+
+    def better_levels(self, price: int) -> int:
+        """Returns the number of levels with a better price than the given one."""
+        prices = self.side.prices
+        if self.side.descending:
+            return len(prices) - bisect_right(prices, price)
+        return bisect_left(prices, price)
+
+    def level_changed(self, price):
+        j = 0 if price is None else self.better_levels(price)
+        if j < len(self.cum_amount):
+            del self.cum_amount[j:]
+            del self.cum_notional[j:]
+        if j < self.memo_levels:
+            self.generation += 1
+            self.memo_levels = 0
+        self.arrays = None
+
+    def price_at(self, j: int) -> int:
+        """Returns the price of the j-th best level."""
+        prices = self.side.prices
+        return prices[len(prices) - 1 - j] if self.side.descending else prices[j]
+
+    def refresh(self, n: int):
+        """Makes sure the prefix sums of the n best levels are valid."""
+        cum_amount, cum_notional = self.cum_amount, self.cum_notional
+        j = len(cum_amount)
+        if j >= n:
+            return
+        levels, prices = self.side.levels, self.side.prices
+        amount = cum_amount[-1] if j > 0 else 0.
+        notional = cum_notional[-1] if j > 0 else 0.
+        last = len(prices) - 1
+        descending = self.side.descending
+        for j in range(j, min(n, len(prices))):
+            price = prices[last - j] if descending else prices[j]
+            level_amount = levels[price].amount
+            amount += level_amount
+            notional += level_amount * price
+            cum_amount.append(amount)
+            cum_notional.append(notional)
+
+    def depth(self, price: int) -> float:
+        """Returns the cumulative amount of all orders priced at least as good as the given price."""
+        prices = self.side.prices
+        n = len(prices) - bisect_left(prices, price) if self.side.descending else bisect_right(prices, price)
+        if n == 0:
+            return 0.
+        self.refresh(n)
+        return self.cum_amount[n - 1]
+
+    def vwap(self, amount: float):
+        """Returns the volume-weighted average price (in cents) to fill the given amount, or None if the side is
+        not deep enough or the amount is not positive."""
+        if amount <= 0:
+            return None
+        entry = self.memo.get(amount, None)
+        if entry is not None and entry[2] == self.generation:
+            return entry[0]
+        cum_amount = self.cum_amount
+        j = bisect_left(cum_amount, amount)
+        n = len(self.side.prices)
+        while j == len(cum_amount) and j < n:  # extend the prefix sums until the amount is covered
+            self.refresh(min(n, max(2 * j, 16)))
+            j = bisect_left(cum_amount, amount, j)
+        if j == len(cum_amount):
+            return None
+        filled = cum_amount[j - 1] if j > 0 else 0.
+        notional = self.cum_notional[j - 1] if j > 0 else 0.
+        result = (notional + (amount - filled) * self.price_at(j)) / amount
+        if len(self.memo) >= self.memo_size:
+            self.memo.clear()
+            self.memo_levels = 0
+        self.memo[amount] = (result, j + 1, self.generation)
+        if j + 1 > self.memo_levels:
+            self.memo_levels = j + 1
+        return result
+
+    def bulk_arrays(self):
+        """Returns the ascending prices and the cumulative amounts in best-first order as numpy arrays."""
+        if self.arrays is None:
+            self.refresh(len(self.side.prices))
+            self.arrays = (numpy.array(self.side.prices, dtype=numpy.int64),
+                           numpy.array(self.cum_amount, dtype=numpy.float64))
+        return self.arrays
+
+    def depths(self, prices):
+        """Bulk variant of depth for a sequence of prices; returns a numpy array if numpy is available."""
+        if numpy is None:
+            return [self.depth(price) for price in prices]
+        ascending, cum_amount = self.bulk_arrays()
+        prices = numpy.asarray(prices)
+        if self.side.descending:
+            n = len(ascending) - numpy.searchsorted(ascending, prices, side="left")
+        else:
+            n = numpy.searchsorted(ascending, prices, side="right")
+        result = numpy.zeros(len(prices))
+        covered = n > 0
+        result[covered] = cum_amount[n[covered] - 1]
+        return result
+
+
+class PairAnalytics(object):
+    """Depth, VWAP and spread queries for one trading pair."""
+
+    def __init__(self, book):
+        self.book = book
+        self.bids = SideAnalytics(book.bids)
+        self.asks = SideAnalytics(book.asks)
+
+    def side(self, order_type: str) -> SideAnalytics:
+        return self.bids if order_type == "buy" else self.asks
+
+    def spread(self):
+        return self.book.spread()
+
+    def buy_vwap(self, amount: float):
+        """Returns the average price to buy the given amount (taking sell orders)."""
+        return self.asks.vwap(amount)
+
+    def sell_vwap(self, amount: float):
+        """Returns the average price to sell the given amount (taking buy orders)."""
+        return self.bids.vwap(amount)
+
+
+class OrderBookAnalytics(object):
+    """Query API on top of a locally maintained OrderBook."""
+
+    def __init__(self, book: OrderBook):
+        self.book = book
+        self.pairs = {}  # trading pair -> PairAnalytics
+
+    def pair(self, trading_pair: str) -> PairAnalytics:
+        analytics = self.pairs.get(trading_pair, None)
+        if analytics is None:
+            analytics = self.pairs[trading_pair] = PairAnalytics(self.book.book(trading_pair))
+        return analytics
@@ -0,0 +1,164 @@
+"""A compact, schema-versioned binary layout for add and rm events, and the decoder for consumers.
+
+A record starts with the byte 0xc1, which never occurs in MessagePack, followed by the schema version, the event kind
+and the sequence number; the numeric fields follow in a fixed struct layout, then the strings (one length byte each,
+255 = None). Trading pairs and order types are interned: they are sent as indices into the tables below, which are
+published with the schema version (see schema) along with the country table of the country bitmasks. Events that do
+not fit the layout are message-packed instead, so consumers can always tell both formats apart by the first byte.
+"""
+from struct import Struct
+
+from bitcoinde.countries import Countries
+
+MAGIC = 0xc1
+VERSION = 3
+
+KIND_ADD = 1
+KIND_RM = 2
+
+TRADING_PAIRS = ("", "btceur", "bcheur", "btgeur", "etheur", "bsveur", "ltceur", "xrpeur", "dogeeur", "soleur",
+                 "trxeur", "usdteur", "usdceur")
+ORDER_TYPES = ("buy", "sell")
+
+HEADER = Struct("<BBBQ")  # magic, version, kind, sequence (0 = none)
+ADD = Struct("<IQqqddBBBBBBBQ")  # timestamp, id, price, volume, amount, min_amount, trading pair, order type,
+# flags, short, po, min trust level, seat of bank (number of its country bit + 1, 0 = none), trade to sepa countries
+RM = Struct("<IQB")  # timestamp, id, trading pair
+
+ADD_FLAGS = ("only_kyc_full", "is_kyc_full", "is_trade_by_sepa_allowed", "is_trade_by_fidor_reservation_allowed",
+             "fidor_account")
+ADD_STRINGS = ("uid", "order_id", "bic_full", "order")
+ADD_FIELDS = frozenset(ADD_FLAGS + ADD_STRINGS + ("id", "price", "volume", "amount", "min_amount", "trading_pair",
+                                                  "order_type", "short", "po", "min_trust_level",
+                                                  "seat_of_bank_of_creator", "trade_to_sepa_country"))
+RM_STRINGS = ("type", "reason", "order_id")
+RM_FIELDS = frozenset(RM_STRINGS + ("id", "trading_pair"))
+
+_pair_codes = dict((pair, i) for i, pair in enumerate(TRADING_PAIRS))
+_order_type_codes = dict((order_type, i) for i, order_type in enumerate(ORDER_TYPES))
+_flag_values = [tuple(flags >> i & 1 for i in range(len(ADD_FLAGS))) for flags in range(1 << len(ADD_FLAGS))]
+
+
+def schema() -> dict:
+    """Describes the layout, published by the sink so that clients can check the version before decoding."""
+    return {"type": "schema", "encoding": "binary", "version": VERSION, "trading_pairs": list(TRADING_PAIRS),
+            "order_types": list(ORDER_TYPES), "countries": list(Countries.codes)}
+
+
+def pack_strings(result: bytearray, values) -> bool:
+    for value in values:
+        if value is None:
+            result.append(255)
+            continue
+        if not isinstance(value, str):
+            return False
+        encoded = value.encode("utf8")
+        if len(encoded) >= 255:
+            return False
+        result.append(len(encoded))
+        result += encoded
+    return True
+
+
+def unpack_strings(message, pos: int, names, data: dict) -> int:
+    for name in names:
+        n = message[pos]
+        pos += 1
+        if n == 255:
+            data[name] = None
+        else:
+            data[name] = message[pos:pos + n].decode("utf8")
+            pos += n
+    return pos
+
+
+def pack_add(event_id, timestamp: float, data: dict, sequence: int):
+    if data.keys() != ADD_FIELDS or str(data["id"]) != str(event_id) or not isinstance(data["id"], int):
+        return None
+    pair = _pair_codes.get(data["trading_pair"], None)
+    order_type = _order_type_codes.get(data["order_type"], None)
+    seat = data["seat_of_bank_of_creator"]
+    if pair is None or order_type is None or type(seat) is not int or seat & (seat - 1) != 0:
+        return None  # the seat of bank is a single country bit (or 0)
+    flags = 0
+    for i, name in enumerate(ADD_FLAGS):
+        value = data[name]
+        if type(value) is not int or value not in (0, 1):
+            return None
+        flags |= value << i
+    try:
+        result = bytearray(HEADER.pack(MAGIC, VERSION, KIND_ADD, sequence or 0))
+        result += ADD.pack(int(timestamp), data["id"], data["price"], data["volume"], data["amount"],
+                           data["min_amount"], pair, order_type, flags, data["short"], data["po"],
+                           data["min_trust_level"], seat.bit_length(), data["trade_to_sepa_country"])
+    except Exception:  # struct.error, TypeError: a value that does not fit the layout
+        return None
+    if not pack_strings(result, [data[name] for name in ADD_STRINGS]):
+        return None
+    return bytes(result)
+
+
+def pack_rm(event_id, timestamp: float, data: dict, sequence: int):
+    if not data.keys() <= RM_FIELDS or "id" not in data or data["id"] != event_id or not isinstance(event_id, str) \
+            or not event_id.isdigit() or str(int(event_id)) != event_id:
+        return None
+    pair = _pair_codes.get(data.get("trading_pair", ""), None)
+    if pair is None or "trading_pair" in data and pair == 0 or any(data.get(name, "") is None for name in RM_STRINGS):
+        return None
+    try:
+        result = bytearray(HEADER.pack(MAGIC, VERSION, KIND_RM, sequence or 0))
+        result += RM.pack(int(timestamp), int(event_id), pair)
+    except Exception:
+        return None
+    if not pack_strings(result, [data.get(name, None) for name in RM_STRINGS]):
+        return None
+    return bytes(result)
+
+
+def pack_event(event_type: str, event_id, timestamp: float, data, sequence=None):
+    """Returns the binary record of an add or rm event, or None if the event does not fit the layout."""
+    if not isinstance(data, dict):
+        return None
+    if event_type == "add":
+        return pack_add(event_id, timestamp, data, sequence)
+    if event_type == "rm":
+        return pack_rm(event_id, timestamp, data, sequence)
+    return None
+
+
+def is_binary(message) -> bool:
+    return len(message) > 0 and message[0] == MAGIC
+
+
+def decode(message) -> dict:
+    """Decodes a binary record into the same message form as the MessagePack encoding (timestamp, type, id, data).
+    Raises ValueError for records of an unknown schema version."""
+    if message[0] != MAGIC or message[1] != VERSION:
+        raise ValueError("Unsupported binary record (version %d), expected version %d" % (message[1], VERSION))
+    _, _, kind, sequence = HEADER.unpack_from(message, 0)
+    pos = HEADER.size
+    if kind == KIND_ADD:
+        timestamp, id, price, volume, amount, min_amount, pair, order_type, flags, short, po, trust, seat, \
+            countries = ADD.unpack_from(message, pos)
+        data = {"id": id, "price": price, "volume": volume, "amount": amount, "min_amount": min_amount,
+                "trading_pair": TRADING_PAIRS[pair], "order_type": ORDER_TYPES[order_type], "short": short, "po": po,
+                "min_trust_level": trust, "seat_of_bank_of_creator": 1 << seat - 1 if seat > 0 else 0,
+                "trade_to_sepa_country": countries}
+        data.update(zip(ADD_FLAGS, _flag_values[flags]))
+        unpack_strings(message, pos + ADD.size, ADD_STRINGS, data)
+        result = {"timestamp": timestamp, "type": "add", "id": str(id), "data": data}
+    elif kind == KIND_RM:
+        timestamp, id, pair = RM.unpack_from(message, pos)
+        data = {"id": str(id)}
+        if pair > 0:
+            data["trading_pair"] = TRADING_PAIRS[pair]
+        unpack_strings(message, pos + RM.size, RM_STRINGS, data)
+        for name in RM_STRINGS:
+            if data[name] is None:
+                del data[name]
+        result = {"timestamp": timestamp, "type": "rm", "id": data["id"], "data": data}
+    else:
+        raise ValueError("Unknown binary record kind: %d" % kind)
+    if sequence > 0:
+        result["seq"] = sequence
+    return result
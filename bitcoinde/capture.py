@@ -0,0 +1,45 @@
+"""Records the raw websocket traffic of all sources, for offline replay (see bitcoinde.replay).
+
+A capture file starts with MAGIC; each record is a RECORD header (receive time, source id, socket.io version, length)
+followed by the bytes exactly as received after the websocket handshake, before frame decoding.
+"""
+from struct import Struct
+
+MAGIC = b"BDECAP1\n"
+RECORD = Struct("<dBBI")  # receive time (unix-time, seconds), source id, socket.io version (9 or 20), length
+
+
+class CaptureWriter(object):
+    """Appends received data to a capture file. Writes are buffered; call close to write the rest."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb", buffering=1024 * 1024)
+        self.file.write(MAGIC)
+        self.records = 0
+
+    def record(self, t: float, sid: int, version: str, data: bytes):
+        self.file.write(RECORD.pack(t, sid, int(version), len(data)))
+        self.file.write(data)
+        self.records += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_capture(path: str):
+    """Yields (receive time, source id, socket.io version, data) of the records of a capture file; stops at a torn
+    record."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a capture file" % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            t, sid, version, n = RECORD.unpack(header)
+            data = f.read(n)
+            if len(data) < n:
+                return
+            yield t, sid, version, data
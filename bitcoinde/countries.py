@@ -1,12 +1,40 @@
+try:
+    import numpy
+except ImportError:  # bulk filtering falls back to a list comprehension
+    numpy = None
+
+
 class Countries(object):
-    def __init__(self):
-        self.codes = ["DE", "AT", "CH", "BE", "GR", "MT", "SI", "BG", "IE", "NL", "SK", "DK", "IT", "ES", "HR", "PL",
-                      "CZ", "EE", "LV", "PT", "HU", "FI", "LT", "RO", "GB", "FR", "LU", "SE", "CY", "IS", "LI", "NO",
-                      "MQ"]
+    """Encodes sets of country codes as bitmasks: bit i stands for codes[i]. Codes that are not in the table set the
+    UNKNOWN bit, which never matches a country. Whether an order can be traded from a country is a single AND:
+    mask & Countries.encode("DE") != 0."""
+    codes = ("DE", "AT", "CH", "BE", "GR", "MT", "SI", "BG", "IE", "NL", "SK", "DK", "IT", "ES", "HR", "PL",
+             "CZ", "EE", "LV", "PT", "HU", "FI", "LT", "RO", "GB", "FR", "LU", "SE", "CY", "IS", "LI", "NO",
+             "MQ")  # append only, the position of a code is its bit
+    bits = dict((code, 1 << i) for i, code in enumerate(codes))
+    UNKNOWN = 1 << 63
 
-    def decode(self, u):
-        pass
+    def decode(self, u: int) -> list:
+        """Returns the country codes of the given bitmask, in table order (the UNKNOWN bit is skipped)."""
+        return [code for i, code in enumerate(self.codes) if u >> i & 1]
+
+    @staticmethod
+    def encode(codes) -> int:
+        """Returns the bitmask of a country code or of a list of country codes ("" and None encode to 0)."""
+        if not codes:
+            return 0
+        if isinstance(codes, str):
+            return Countries.bits.get(codes, Countries.UNKNOWN)
+        i = 0
+        for code in codes:
+            i |= Countries.bits.get(code, Countries.UNKNOWN)
+        return i
 
     @staticmethod
-    def encode(codes):
-        i, j = 0, 0
+    def eligible(masks, country: str):
+        """Bulk variant of mask & encode(country) != 0 for a sequence of masks, for instance the
+        trade_to_sepa_country values of many orders; returns a numpy bool array if numpy is available."""
+        bit = Countries.bits.get(country, 0)
+        if numpy is None:
+            return [mask & bit != 0 for mask in masks]
+        return numpy.bitwise_and(numpy.asarray(masks, dtype=numpy.uint64), numpy.uint64(bit)) != 0
@@ -0,0 +1,158 @@
+import threading
+from collections import deque
+from time import time
+
+from bitcoinde.events import Event, EventSink
+
+BLOCK = "block"  # the delivering thread waits until the queue has room
+DROP_OLDEST = "drop-oldest"  # the oldest queued event is discarded
+DROP_NEWEST = "drop-newest"  # the event that does not fit is discarded
+
+
+class ReactorEventSink(EventSink):
+    """Delivers events to the wrapped sink synchronously on the reactor thread; deadlines are scheduled as reactor
+    timers."""
+
+    def __init__(self, sink: EventSink):
+        self.sink = sink
+        self.delivered = 0
+        self.flush_call = None
+        sink.open()
+        self.schedule()
+
+    def process_event(self, event: Event):
+        self.sink.process_event(event)
+        self.delivered += 1
+        if self.flush_call is None:
+            self.schedule()
+
+    def schedule(self):
+        deadline = self.sink.deadline()
+        if deadline is not None:
+            from twisted.internet import reactor
+            self.flush_call = reactor.callLater(max(0., deadline - time()), self.flush)
+
+    def flush(self):
+        self.flush_call = None
+        self.sink.flush()
+        self.schedule()
+
+    def close(self):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        self.sink.close()
+
+    def stats(self) -> dict:
+        return {"sink": type(self.sink).__name__, "delivered": self.delivered}
+
+
+class QueuedEventSink(EventSink):
+    """Delivers events to the wrapped sink on a worker thread of its own, through a bounded queue, so a slow sink
+    neither delays the reactor nor the other sinks. The policy decides what happens if the queue is full: BLOCK,
+    DROP_OLDEST or DROP_NEWEST. Queue depth and drop counters are available via stats. If the wrapped sink fails to
+    open, the worker stops and all further events are dropped; the error is kept in open_error."""
+
+    def __init__(self, sink: EventSink, max_size=10000, policy=BLOCK):
+        if policy not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("Unknown queue policy: %s" % policy)
+        self.sink = sink
+        self.max_size = max_size
+        self.policy = policy
+
+        self.queue = deque()
+        lock = threading.Lock()
+        self.not_empty = threading.Condition(lock)
+        self.not_full = threading.Condition(lock)
+        self.running = True
+        self.open_error = None  # the exception raised by sink.open, if any
+
+        self.delivered, self.dropped, self.errors, self.max_depth = 0, 0, 0, 0
+
+        self.thread = threading.Thread(target=self.run, name="sink-%s" % type(sink).__name__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def process_event(self, event: Event):
+        """Enqueues the event; called on the reactor thread."""
+        with self.not_empty:
+            if self.open_error is not None:
+                self.dropped += 1
+                return
+            queue = self.queue
+            if len(queue) >= self.max_size:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.policy == DROP_OLDEST:
+                    queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(queue) >= self.max_size and self.running:
+                        self.not_full.wait()
+                    if self.open_error is not None:
+                        self.dropped += 1
+                        return
+            queue.append(event)
+            if len(queue) > self.max_depth:
+                self.max_depth = len(queue)
+            self.not_empty.notify()
+
+    def run(self):
+        sink, queue = self.sink, self.queue
+        try:
+            sink.open()
+        except Exception as e:
+            print("QueuedEventSink: %s failed to open" % type(sink).__name__, e)
+            with self.not_empty:
+                self.open_error = e
+                self.running = False
+                self.dropped += len(queue)
+                queue.clear()
+                self.not_full.notify_all()  # releases a reactor thread blocked on the full queue
+            return
+        while True:
+            with self.not_empty:
+                while len(queue) == 0 and self.running:
+                    deadline = sink.deadline()
+                    if deadline is None:
+                        self.not_empty.wait()
+                    else:
+                        timeout = deadline - time()
+                        if timeout <= 0:
+                            break
+                        self.not_empty.wait(timeout)
+                if len(queue) > 0:
+                    event = queue.popleft()
+                    self.not_full.notify()
+                elif not self.running:
+                    break
+                else:
+                    event = None  # the deadline has passed
+            try:
+                if event is not None:
+                    sink.process_event(event)
+                    self.delivered += 1
+                    deadline = sink.deadline()  # the queue may not run empty under sustained load
+                    if deadline is not None and time() >= deadline:
+                        event = None
+                if event is None:
+                    sink.flush()
+            except Exception as e:
+                self.errors += 1
+                print("QueuedEventSink: %s failed" % type(sink).__name__, e)
+        sink.close()
+
+    def close(self):
+        """Delivers the queued events, then stops the worker thread."""
+        with self.not_empty:
+            self.running = False
+            self.not_empty.notify()
+            self.not_full.notify_all()
+        self.thread.join()
+
+    def stats(self) -> dict:
+        return {"sink": type(self.sink).__name__, "policy": self.policy, "depth": len(self.queue),
+                "max_depth": self.max_depth, "max_size": self.max_size, "delivered": self.delivered,
+                "dropped": self.dropped, "errors": self.errors,
+                "open_error": None if self.open_error is None else repr(self.open_error)}
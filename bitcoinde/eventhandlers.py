@@ -1,124 +1,118 @@
+from hashlib import blake2b
+
 from bitcoinde.countries import Countries
 from bitcoinde.events import BitcoinWebSocketEventHandler
+from bitcoinde.schema import Field, compile_schema
 
 
 class BitcoinWebSocketRemoveOrder(BitcoinWebSocketEventHandler):
-    def __init__(self):
-        super(BitcoinWebSocketRemoveOrder, self).__init__("rm")
+    id_field = "id"
+
+    def __init__(self, **kwargs):
+        super(BitcoinWebSocketRemoveOrder, self).__init__("rm", **kwargs)
 
     def generate_id(self, data):
         return data['id']
 
 
+TRUST_LEVELS = {
+    "bronze": 1,
+    "silver": 2,
+    "gold": 3,
+    "platinum": 4
+}
+
+
+def map_trust_level(name: str) -> int:
+    return TRUST_LEVELS.get(name, 0)
+
+
+ADD_ORDER_SCHEMA = (
+    Field("id", conversion="int"),  # event-id
+    Field("po", "payment_option", "int"),
+    Field("short", ("is_shorting", "is_shorting_allowed"), "int"),  # is_shorting * 2 + is_shorting_allowed
+    Field("is_trade_by_fidor_reservation_allowed", conversion="int"),
+    Field("is_trade_by_sepa_allowed", conversion="int"),
+    Field("uid", optional=True),
+    Field("order_id", optional=True),
+    Field("price", conversion="cents"),
+    Field("volume", conversion="cents"),
+    Field("bic_full", optional=True),
+    Field("only_kyc_full", conversion="int"),
+    Field("is_kyc_full", conversion="int"),
+    Field("amount", conversion="float"),
+    Field("min_amount", conversion="float"),
+    Field("order_type", optional=True),
+    Field("order", optional=True),
+    Field("min_trust_level", conversion=map_trust_level, optional=True),
+    Field("seat_of_bank_of_creator", conversion=Countries.encode, optional=True),  # bitmask
+    Field("trading_pair", optional=True),
+    Field("trade_to_sepa_country", conversion=Countries.encode, optional=True),  # bitmask
+    Field("fidor_account", conversion="int")
+)
+
+
 class BitcoinWebSocketAddOrder(BitcoinWebSocketEventHandler):
-    def __init__(self):
-        super(BitcoinWebSocketAddOrder, self).__init__("add")
+    id_field = "id"
+    convert = staticmethod(compile_schema("add", ADD_ORDER_SCHEMA))
 
-        self.countries = Countries()
+    def __init__(self, **kwargs):
+        super(BitcoinWebSocketAddOrder, self).__init__("add", **kwargs)
 
-        def map_trust_level(name: str) -> int:
-            levels = {
-                "bronze": 1,
-                "silver": 2,
-                "gold": 3,
-                "platinum": 4
-            }
-            return levels.get(name, 0)
-
-        self.trans = {
-            "id": ("id", lambda x: x),  # event-id
-            "uid": ("uid", lambda x: x),
-            "order_id": ("order_id", lambda x: x),
-            "id": ("id", lambda x: int(x)),
-            "price": ("price", lambda x: int(float(x) * 100)),
-            "volume": ("volume", lambda x: int(float(x) * 100)),
-            "bic_full": ("bic_full", lambda x: x),
-            "only_kyc_full": ("only_kyc_full", lambda x: int(x)),
-            "is_kyc_full": ("is_kyc_full", lambda x: int(x)),
-            "is_trade_by_sepa_allowed": ("is_trade_by_sepa_allowed", lambda x: int(x)),
-            "is_trade_by_fidor_reservation_allowed": ("is_trade_by_fidor_reservation_allowed", lambda x: int(x)),
-            "amount": ("amount", lambda x: float(x)),
-            "min_amount": ("min_amount", lambda x: float(x)),
-            "order_type": ("order_type", lambda x: x),
-            "order": ("order", lambda x: x),
-            "min_trust_level": ("min_trust_level", lambda x: map_trust_level(x),),
-            "seat_of_bank_of_creator": ("seat_of_bank_of_creator", lambda x: x),
-            "trading_pair": ("trading_pair", lambda x: x),
-            "trade_to_sepa_country": ("trade_to_sepa_country", lambda x: x),
-            "fidor_account": ("fidor_account", lambda x: int(x))
-        }
-        # self.trans["is_shorting"]
-        # self.trans["is_shorting_allowed"]
+        self.countries = Countries()
 
     def generate_id(self, data: dict):
         return data['id']
 
     def retrieve_data(self, data):
-        is_shorting = int(data["is_shorting"])
-        is_shorting_allowed = int(data["is_shorting_allowed"])
-        short = is_shorting * 2 + is_shorting_allowed
-
-        is_trade_by_fidor_reservation_allowed = int(data["is_trade_by_fidor_reservation_allowed"])
-        is_trade_by_sepa_allowed = int(data["is_trade_by_sepa_allowed"])
-        payment_option = int(data["payment_option"])
-        result: dict = {
-            "id": self.generate_id(data),
-            "po": payment_option,
-            "short": short,
-            "is_trade_by_fidor_reservation_allowed": is_trade_by_fidor_reservation_allowed,
-            "is_trade_by_sepa_allowed": is_trade_by_sepa_allowed
-        }
-
-        # print(is_trade_by_fidor_reservation_allowed, is_trade_by_sepa_allowed, payment_option, short)
-        for key, mapping_tuple in self.trans.items():
-            property_name, mapping_func, = mapping_tuple
-            x = data.get(key)
-            result[property_name] = mapping_func(x)
-
-        return result
+        """Converts the payload according to ADD_ORDER_SCHEMA; raises SchemaError for malformed fields."""
+        return self.convert(data)
 
 
 class BitcoinWebSocketSkn(BitcoinWebSocketEventHandler):
-    def __init__(self):
-        super(BitcoinWebSocketSkn, self).__init__("skn")
+    id_field = "uid"
+
+    def __init__(self, **kwargs):
+        super(BitcoinWebSocketSkn, self).__init__("skn", **kwargs)
 
     def generate_id(self, data):
         return data['uid']
 
 
 class BitcoinWebSocketSpr(BitcoinWebSocketEventHandler):
+    id_field = "uid"
 
-    def __init__(self):
-        super(BitcoinWebSocketSpr, self).__init__("spr")
+    def __init__(self, **kwargs):
+        super(BitcoinWebSocketSpr, self).__init__("spr", **kwargs)
 
-    def generate_id(data):
+    def generate_id(self, data):
         return data['uid']
 
 
 class BitcoinWebSocketRefreshExpressOption(BitcoinWebSocketEventHandler):
-    """This event will be send in case an order´s payment options have been changed."""
+    """This event will be send in case an order´s payment options have been changed. A single message may refresh
+    many orders; they are forwarded as parallel arrays, sorted by id: {"ids": [...], "po": [...]}."""
 
-    def __init__(self):
-        super(BitcoinWebSocketRefreshExpressOption, self).__init__("po")
+    def __init__(self, **kwargs):
+        super(BitcoinWebSocketRefreshExpressOption, self).__init__("po", **kwargs)
 
-    def generate_id(self, data):
-        result_id, j = 0, 1
+    @staticmethod
+    def payment_options(data: dict) -> list:
+        """Returns the (id, po) pairs of the payload, sorted by id."""
+        result = []
         for key, value in data.items():  # key must be a numeric id, for instance: 58015351
             is_trade_by_fidor_reservation_allowed = int(value.get("is_trade_by_fidor_reservation_allowed", "0"))
-            m = (is_trade_by_fidor_reservation_allowed * 2 - 1)
-            result_id += int(key) * m * j  # wtf; would say the id remains the same...
-            j += 1
-        return str(result_id)
+            is_trade_by_sepa_allowed = int(value.get("is_trade_by_sepa_allowed", "0"))
+            result.append((int(key), is_trade_by_fidor_reservation_allowed + is_trade_by_sepa_allowed * 2))
+        result.sort()
+        return result
 
-    def retrieve_data(self, data):
-        result_dict: dict = {}
-        for key, value in data.items():  # items() method should return a single dict, whereby
-            # key must be a numeric id, for instance: 58015351
-            is_trade_by_fidor_reservation_allowed = int(value.get("is_trade_by_fidor_reservation_allowed", "0"))
-            is_trade_by_sepa_allowed = int(value.get("u'is_trade_by_sepa_allowed", "0"))
-            payment_option = is_trade_by_fidor_reservation_allowed + is_trade_by_sepa_allowed * 2
-            result_dict["id"] = str(key)
-            result_dict["po"] = payment_option
-            break  # TODO: add id/po items to arrays
-        return result_dict
+    def generate_id(self, data):
+        """Hashes the canonical form of all (id, po) pairs; identical refreshes received from several sources get
+        the same id, different ones do not collide."""
+        canonical = ",".join("%d:%d" % pair for pair in self.payment_options(data))
+        return blake2b(canonical.encode("ascii"), digest_size=16).hexdigest()
 
+    def retrieve_data(self, data):
+        pairs = self.payment_options(data)
+        return {"ids": [str(id) for id, _ in pairs], "po": [po for _, po in pairs]}
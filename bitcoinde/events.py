@@ -1,21 +1,58 @@
 # from time import time
 # from twisted.internet import task
+import re
+import threading
+
 import msgpack
 
+from bitcoinde import binary
+from bitcoinde.statistics import ArrivalStatistics
+from bitcoinde.timingwheel import TimingWheel
+
+
+def pack_msgpack(event) -> bytes:
+    message = {
+        "timestamp": int(event.timestamp),
+        "type": event.event_type,
+        "id": event.event_id,
+        "data": event.event_data
+    }
+    if event.sequence is not None:
+        message["seq"] = event.sequence
+    return msgpack.packb(message)
+
+
+def pack_binary(event) -> bytes:
+    """Compact layout for add and rm events (see bitcoinde.binary), other events are message-packed."""
+    packed = binary.pack_event(event.event_type, event.event_id, event.timestamp, event.event_data, event.sequence)
+    return packed if packed is not None else pack_msgpack(event)
+
 
 class Event(object):
+    __slots__ = ("event_id", "event_type", "timestamp", "sources", "event_data", "sequence", "encoded")
+    encoders = {"msgpack": pack_msgpack, "binary": pack_binary}  # encoding name -> function(event) -> bytes
+    encode_lock = threading.Lock()
+
     def __init__(self, event_id, event_type: str, unix_time_seconds: float):
         self.event_id = event_id
         self.event_type = event_type
         self.timestamp = unix_time_seconds
         self.sources = []
         self.event_data = {}
+        self.sequence = None  # stamped by BitcoinWebSocketMulti.deliver
+        self.encoded = None  # encoding name -> bytes, filled on first use
+
+    @staticmethod
+    def register_encoding(name: str, encoder):
+        """Makes an alternative serialization available to all sinks via encode(name)."""
+        Event.encoders[name] = encoder
 
     def add_source(self, at, src):
         self.sources.append((at, src,))
 
     def add_data(self, data):
         self.event_data = data
+        self.encoded = None
 
     def since(self):
         if len(self.sources) == 0:
@@ -28,70 +65,113 @@ class Event(object):
     def __str__(self):
         return "Event %s %s %s" % (self.event_type, self.event_id, self.event_data)
 
+    def encode(self, encoding="msgpack") -> bytes:
+        """Returns the serialized event. Each encoding is computed at most once per event, the bytes are shared by
+        all sinks (and their threads), hence the event data must not be modified once the event is delivered."""
+        encoded = self.encoded
+        if encoded is not None and encoding in encoded:
+            return encoded[encoding]
+        encoder = Event.encoders.get(encoding, None)
+        if encoder is None:
+            raise ValueError("Unknown encoding: %s" % encoding)
+        with Event.encode_lock:
+            if self.encoded is None:
+                self.encoded = {}
+            result = self.encoded.get(encoding, None)
+            if result is None:
+                result = self.encoded[encoding] = bytes(encoder(self))
+        return result
+
     def pack(self) -> bytes:
         """Serializes the current message to MessagePack format."""
-        message = {
-            "timestamp": int(self.timestamp),
-            "type": self.event_type,
-            "id": self.event_id,
-            "data": self.event_data
-        }
-        return msgpack.packb(message)
+        return self.encode("msgpack")
 
 
 class EventSink(object):
-    """A base class for event processors intended to be injected into a multi-source."""
+    """A base class for event processors intended to be injected into a multi-source. All methods are called on
+    the thread that delivers events to the sink."""
+
+    def open(self):
+        """Called once before the first event is delivered."""
+        pass
 
     def process_event(self, event: Event):
         """To be implemented by a derived type."""
         pass
 
+    def deadline(self):
+        """Returns the time (unix-time, seconds) at which flush must be called, or None."""
+        return None
+
+    def flush(self):
+        """Called at the deadline, for instance to send buffered events."""
+        pass
+
+    def close(self):
+        pass
+
 
 class BitcoinWebSocketEventHandler(object):
     """Handles an event stream, for example 'add'-Events. ProcessEvent only forwards the first occurrence of an event
     from one of the sources. Already received events get timestamped-data via AddSource"""
+    id_field = None  # name of the payload field generate_id returns; enables the raw pre-dedup stage
 
-    def __init__(self, event_name: str, interval_seconds=60):
+    def __init__(self, event_name: str, retention_seconds=60., tick_seconds=1., adaptive_retention=False):
         self.event_name = event_name
+        self.events = TimingWheel(retention_seconds, tick_seconds, adaptive_retention)
+        self.statistics = ArrivalStatistics()
         from twisted.internet import task
         self.check_task = task.LoopingCall(self.__clean_up)
-        self.interval = interval_seconds  # Remove old Events from stream
+        self.interval = tick_seconds  # Remove old Events from stream, one bucket per tick
         run_immediately = False
         self.check_task.start(self.interval, run_immediately)
-        self.events = {}
+        self.id_pattern = None
+        if self.id_field is not None:
+            self.id_pattern = re.compile(r'"%s"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)' % self.id_field)
 
     def generate_id(self, data) -> str:
         """Returns None. Must be implemented by derived types."""
         return None
 
-    def __clean_up(self):
-        """Removes old events from stream periodically (automatically called by reactor using a LoopingCall)."""
-        from time import time
-        now = time()
-        events = {}
-        n, m, dt, ll, srcl = 0, 0, [1000, 0, 0], {}, {}
-        for key, value in self.events.items():
-            s, d, sources = value.since()
-            if s >= now - self.interval:
-                events[key] = value
-                n += 1
-            else:
-                m += 1
-                dt[0] = min(dt[0], d)
-                dt[1] += d
-                dt[2] = max(dt[2], d)
-
-                src, length = sources[0], len(sources)
-                srcl[src] = srcl.get(src, 0) + 1
-                ll[length] = ll.get(length, 0) + 1
-
-        if m > 0:
-            dt[1] = dt[1] / (1. * m)
-        else:
-            dt[0] = 0
+    def scan_id(self, raw: str):
+        """Extracts the event id from the undecoded JSON payload without parsing it. Returns the same value
+        generate_id would return for the decoded payload, or None if the id cannot be extracted cheaply. A key that
+        occurs more than once may belong to a nested object, such payloads are left to the JSON decoder."""
+        if self.id_pattern is None:
+            return None
+        match = self.id_pattern.search(raw)
+        if match is None or self.id_pattern.search(raw, match.end()) is not None:
+            return None
+        value = match.group(1)
+        if value[0] != '"':
+            return int(value)
+        if "\\" in value:
+            return None  # escaped strings are left to the JSON decoder
+        return value[1:-1]
+
+    def process_raw_event(self, raw: str, src: int, unix_time_seconds: float) -> bool:
+        """Pre-dedup stage: records the arrival of an already known event from its raw payload. Returns False,
+        if the payload must be decoded and passed to process_event."""
+        event_id = self.scan_id(raw)
+        if event_id is None:
+            return False
+        evt = self.events.get(event_id, None)
+        if evt is None:
+            return False
+        evt.add_source(unix_time_seconds, src)
+        self.late_arrival(evt, src, unix_time_seconds)
+        return True
+
+    def late_arrival(self, evt: Event, src: int, unix_time_seconds: float):
+        """Accounts another arrival of an already known event."""
+        lag = unix_time_seconds - evt.timestamp
+        self.events.observe_skew(lag)
+        self.statistics.late_arrival(src, lag)
 
-        self.events = events
-        # print("Cleanup", self.event_name, n, m, map(lambda x: "%.6f" % x, dt), ll, srcl)
+    def __clean_up(self):
+        """Expires the oldest bucket of events (automatically called by reactor using a LoopingCall)."""
+        for evt in self.events.tick():
+            self.statistics.event_expired(evt)
 
     def process_event(self, data: dict, src: int, unix_time_seconds: float) -> Event:
         event_id = self.generate_id(data)
@@ -102,8 +182,10 @@ class BitcoinWebSocketEventHandler(object):
                 evt = Event(event_id, self.event_name, unix_time_seconds)
                 event_data = self.retrieve_data(data)
                 evt.add_data(event_data)
-                self.events[event_id] = evt
+                self.events.insert(event_id, evt)
+                self.statistics.first_arrival(src)
                 return evt
+            self.late_arrival(evt, src, unix_time_seconds)
         finally:
             evt.add_source(unix_time_seconds, src)
 
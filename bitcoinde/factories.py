@@ -17,6 +17,16 @@ class MultiSource(Factory):
     def on_event(self, event_type: str, data, t):
         self.receiver.receive_event(event_type, data, self.sid, t)
 
+    def on_raw_data(self, data: bytes, t):
+        """Passes the data received after the websocket handshake to the capture recorder, if any."""
+        recorder = self.receiver.recorder
+        if recorder is not None:
+            recorder.record(t, self.sid, self.socket_version, data)
+
+    def on_raw_event(self, event_type: str, raw: str, t) -> bool:
+        """Offers the undecoded payload to the receiver; returns True if the event is a duplicate."""
+        return self.receiver.receive_raw_event(event_type, raw, self.sid, t)
+
     def startFactory(self):
         print("%s started" % self)
 
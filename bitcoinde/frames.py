@@ -0,0 +1,92 @@
+from struct import unpack_from
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+
+class WebSocketFrameDecoder(object):
+    """Incrementally decodes WebSocket frames from a TCP byte stream. Received chunks are accumulated into a single
+    reusable buffer; a chunk may contain several frames, or only a part of one. Each complete message is handed to
+    the given callback as (opcode, payload), whereby payload is a memoryview into the buffer that is only valid for
+    the duration of the call. Fragmented messages are reassembled from their continuation frames."""
+
+    def __init__(self, on_frame):
+        self.on_frame = on_frame  # callback(opcode: int, payload: memoryview)
+        self.buffer = bytearray()
+        self.fragments = bytearray()  # payload of a fragmented message received so far
+        self.fragment_opcode = None
+
+    def feed(self, data):
+        """Appends the given chunk to the buffer and dispatches all frames that are complete."""
+        buffer = self.buffer
+        buffer += data
+        end, pos = len(buffer), 0
+        view = memoryview(buffer)
+        try:
+            while end - pos >= 2:
+                b0, b1 = buffer[pos], buffer[pos + 1]
+                length, header = b1 & 0x7f, 2
+                if length == 126:
+                    if end - pos < 4:
+                        break
+                    length, header = unpack_from('!H', buffer, pos + 2)[0], 4
+                elif length == 127:
+                    if end - pos < 10:
+                        break
+                    length, header = unpack_from('!Q', buffer, pos + 2)[0], 10
+                mask = None
+                if b1 & 0x80:  # servers must not mask their frames, but be lenient
+                    if end - pos < header + 4:
+                        break
+                    mask = bytes(buffer[pos + header:pos + header + 4])
+                    header += 4
+
+                start = pos + header
+                if end - start < length:
+                    break  # wait for the remainder of the frame
+                pos = start + length
+
+                with view[start:pos] as payload:
+                    if mask is not None:
+                        payload = memoryview(self.unmask(payload, mask))
+                    self.dispatch(b0 & 0x80, b0 & 0x0f, payload)
+        finally:
+            view.release()
+            if pos > 0:
+                del buffer[:pos]
+
+    def dispatch(self, fin, opcode, payload):
+        if opcode >= OPCODE_CLOSE:  # control frames may be interleaved with the fragments of a message
+            self.on_frame(opcode, payload)
+        elif opcode == OPCODE_CONTINUATION:
+            if self.fragment_opcode is None:
+                print("WebSocketFrameDecoder: continuation frame without a message to continue")
+                return
+            self.fragments += payload
+            if fin:
+                opcode, self.fragment_opcode = self.fragment_opcode, None
+                with memoryview(self.fragments) as message:
+                    self.on_frame(opcode, message)
+                del self.fragments[:]
+        elif fin:
+            self.on_frame(opcode, payload)
+        else:
+            self.fragment_opcode = opcode
+            del self.fragments[:]
+            self.fragments += payload
+
+    @staticmethod
+    def unmask(payload, mask: bytes) -> bytes:
+        n = len(payload)
+        key = int.from_bytes((mask * (n // 4 + 1))[:n], 'big')
+        return (int.from_bytes(payload, 'big') ^ key).to_bytes(n, 'big')
+
+    def reset(self):
+        """Drops all buffered data, for instance after the connection has been lost."""
+        del self.buffer[:]
+        del self.fragments[:]
+        self.fragment_opcode = None
@@ -0,0 +1,180 @@
+"""An append-only, segmented event journal on disk, and its reader.
+
+A journal directory holds numbered segments (<sequence>.journal). Each record is a RECORD header (payload length,
+event timestamp) followed by the serialized event (Event.encode, msgpack or binary). Next to each segment, a sparse
+index (<sequence>.index) maps event timestamps to record offsets, with one INDEX entry per index_interval seconds,
+so time-range reads seek to the start instead of scanning. Events are journaled in the order they are delivered,
+which is the order of their timestamps.
+"""
+import os
+from bisect import bisect_left
+from struct import Struct
+from time import time
+
+import msgpack
+
+from bitcoinde import binary
+from bitcoinde.events import Event, EventSink
+
+RECORD = Struct("<Id")  # payload length, event timestamp (unix-time, seconds)
+INDEX = Struct("<dQ")  # event timestamp, record offset in the segment
+SEGMENT_SUFFIX = ".journal"
+INDEX_SUFFIX = ".index"
+
+
+def segments(directory: str) -> list:
+    """Returns the sequence numbers of the segments in the directory, in ascending order."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                  if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+
+def segment_path(directory: str, sequence: int, suffix=SEGMENT_SUFFIX) -> str:
+    return os.path.join(directory, "%016d%s" % (sequence, suffix))
+
+
+class EventJournal(EventSink):
+    """Appends every delivered event to the journal. Writes are buffered and made durable in groups: the files are
+    fsync'ed at most sync_interval seconds after the first unsynced event (0 syncs every event, None leaves it to
+    the operating system), and whenever a segment is completed. A new segment is started once the current one
+    exceeds segment_bytes, and on every start, so a torn record can only ever be the last one of a segment.
+
+    Disk I/O must not run on the reactor thread: register the journal with a queue (write_to's default)."""
+
+    def __init__(self, directory: str, encoding="msgpack", segment_bytes=64 * 1024 * 1024, sync_interval=0.05,
+                 index_interval=1.):
+        if encoding not in Event.encoders:
+            raise ValueError("Unknown encoding: %s" % encoding)
+        self.directory = directory
+        self.encoding = encoding
+        self.segment_bytes = segment_bytes
+        self.sync_interval = sync_interval
+        self.index_interval = index_interval
+
+        self.sequence = None
+        self.segment = None
+        self.index = None
+        self.offset = 0
+        self.indexed_at = None  # timestamp of the last index entry
+        self.sync_deadline = None
+
+        self.records, self.syncs = 0, 0
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        existing = segments(self.directory)
+        self.sequence = existing[-1] if len(existing) > 0 else 0
+        self.rotate()
+
+    def rotate(self):
+        """Completes the current segment, if any, and starts the next one."""
+        if self.segment is not None:
+            self.sync()
+            self.segment.close()
+            self.index.close()
+        self.sequence += 1
+        self.segment = open(segment_path(self.directory, self.sequence), "xb", buffering=1024 * 1024)
+        self.index = open(segment_path(self.directory, self.sequence, INDEX_SUFFIX), "xb")
+        self.offset = 0
+        self.indexed_at = None
+
+    def process_event(self, event: Event):
+        payload = event.encode(self.encoding)
+        timestamp = event.timestamp
+        if self.indexed_at is None or timestamp >= self.indexed_at + self.index_interval:
+            self.index.write(INDEX.pack(timestamp, self.offset))
+            self.indexed_at = timestamp
+        self.segment.write(RECORD.pack(len(payload), timestamp))
+        self.segment.write(payload)
+        self.offset += RECORD.size + len(payload)
+        self.records += 1
+        if self.offset >= self.segment_bytes:
+            self.rotate()
+        elif self.sync_deadline is None and self.sync_interval is not None:
+            self.sync_deadline = time() + self.sync_interval
+
+    def deadline(self):
+        return self.sync_deadline
+
+    def flush(self):
+        self.sync()
+
+    def sync(self):
+        """Writes the buffered records to disk; the segment is synced before its index, so that index entries
+        never point beyond the durable records."""
+        self.sync_deadline = None
+        durable = self.sync_interval is not None
+        self.segment.flush()
+        if durable:
+            os.fsync(self.segment.fileno())
+        self.index.flush()
+        if durable:
+            os.fsync(self.index.fileno())
+            self.syncs += 1
+
+    def close(self):
+        if self.segment is not None:
+            self.sync()
+            self.segment.close()
+            self.index.close()
+            self.segment = None
+
+    def stats(self) -> dict:
+        return {"segment": self.sequence, "offset": self.offset, "records": self.records, "syncs": self.syncs}
+
+
+class JournalReader(object):
+    """Reads the events of a journal directory within a time range."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def read_index(self, sequence: int) -> list:
+        """Returns the (timestamp, offset) entries of a segment."""
+        with open(segment_path(self.directory, sequence, INDEX_SUFFIX), "rb") as f:
+            data = f.read()
+        n = len(data) // INDEX.size
+        return [INDEX.unpack_from(data, i * INDEX.size) for i in range(n)]
+
+    def records(self, start=None, end=None):
+        """Yields (timestamp, payload) of all records with start <= timestamp <= end (None: unbounded)."""
+        indexes = [(sequence, self.read_index(sequence)) for sequence in segments(self.directory)]
+        indexes = [(sequence, index) for sequence, index in indexes if len(index) > 0]
+        for i, (sequence, index) in enumerate(indexes):
+            if end is not None and index[0][0] > end:
+                break
+            if start is not None and i + 1 < len(indexes) and indexes[i + 1][1][0][0] < start:
+                continue  # the next segment starts before the range
+            offset = 0
+            if start is not None:
+                j = bisect_left(index, (start,)) - 1  # the last entry before the range
+                offset = index[j][1] if j >= 0 else 0
+            for timestamp, payload in self.scan(sequence, offset):
+                if end is not None and timestamp > end:
+                    return
+                if start is None or timestamp >= start:
+                    yield timestamp, payload
+
+    def scan(self, sequence: int, offset: int):
+        """Yields (timestamp, payload) of the records of a segment from the given offset on; stops at a torn
+        record."""
+        with open(segment_path(self.directory, sequence), "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return
+                n, timestamp = RECORD.unpack(header)
+                payload = f.read(n)
+                if len(payload) < n:
+                    return
+                yield timestamp, payload
+
+    def events(self, start=None, end=None):
+        """Yields the decoded events (message form, see README) within the time range."""
+        for _, payload in self.records(start, end):
+            if binary.is_binary(payload):
+                yield binary.decode(payload)
+            else:
+                yield msgpack.unpackb(payload, raw=False)
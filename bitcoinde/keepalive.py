@@ -0,0 +1,60 @@
+class KeepAlive(object):
+    """Keeps a single websocket connection alive. Pings are sent every interval by one timer, and a second timer
+    watches the connection: if neither data nor a pong has been received for timeout seconds, the connection is
+    considered stale and on_stale is called. Receiving data only records the time, the watchdog re-arms itself
+    for the remaining time when it fires, so no timer is touched per received chunk.
+
+    rtt is only measured by protocols that call pong_received: socket.io 2.0 answers every ping with a pong. The
+    heartbeats of socket.io 0.9 are not answered (the server sends heartbeats on its own schedule), so the 0.9
+    connections have no round trip time and rtt stays None."""
+
+    def __init__(self, clock, send_ping, on_stale, interval_seconds: float, timeout_seconds: float):
+        self.clock = clock  # the reactor, or any IReactorTime provider
+        self.send_ping = send_ping
+        self.on_stale = on_stale
+        self.interval = interval_seconds
+        self.timeout = timeout_seconds
+
+        self.ping_call = None
+        self.watchdog_call = None
+        self.last_activity_at = 0
+        self.ping_sent_at = 0
+        self.pings, self.pongs = 0, 0
+        self.rtt = None  # round trip time of the last ping, in seconds (None without pongs, see above)
+
+    def start(self, first_ping_seconds=None):
+        self.stop()
+        self.last_activity_at = self.clock.seconds()
+        delay = self.interval if first_ping_seconds is None else first_ping_seconds
+        self.ping_call = self.clock.callLater(delay, self.ping)
+        self.watchdog_call = self.clock.callLater(self.timeout, self.watch)
+
+    def stop(self):
+        for call in (self.ping_call, self.watchdog_call):
+            if call is not None and call.active():
+                call.cancel()
+        self.ping_call, self.watchdog_call = None, None
+
+    def data_received(self):
+        self.last_activity_at = self.clock.seconds()
+
+    def pong_received(self):
+        self.pongs += 1
+        self.data_received()
+        if self.ping_sent_at > 0:
+            self.rtt = self.last_activity_at - self.ping_sent_at
+
+    def ping(self):
+        self.pings += 1
+        self.ping_sent_at = self.clock.seconds()
+        self.send_ping()
+        self.ping_call = self.clock.callLater(self.interval, self.ping)
+
+    def watch(self):
+        idle = self.clock.seconds() - self.last_activity_at
+        if idle < self.timeout:
+            self.watchdog_call = self.clock.callLater(self.timeout - idle, self.watch)
+        else:
+            self.watchdog_call = None
+            self.stop()
+            self.on_stale(idle)
@@ -0,0 +1,41 @@
+"""Helpers for producers and consumers of the messages published by ZeroMqEventProcessingSink."""
+from struct import pack
+
+import msgpack
+
+from bitcoinde import binary
+
+
+def pack_bin(data: bytes) -> bytes:
+    """Wraps the given bytes into a msgpack bin object."""
+    n = len(data)
+    if n < 0x100:
+        return pack('>BB', 0xc4, n) + data
+    elif n < 0x10000:
+        return pack('>BH', 0xc5, n) + data
+    return pack('>BI', 0xc6, n) + data
+
+
+def pack_batch(packed_events: list) -> bytes:
+    """Combines already message-packed events into one msgpack array without re-encoding them. Binary records
+    (see bitcoinde.binary) become bin objects of the array."""
+    packed_events = [pack_bin(packed) if binary.is_binary(packed) else packed for packed in packed_events]
+    n = len(packed_events)
+    if n < 16:
+        header = bytes((0x90 | n,))
+    elif n < 0x10000:
+        header = pack('>BH', 0xdc, n)
+    else:
+        header = pack('>BI', 0xdd, n)
+    return header + b"".join(packed_events)
+
+
+def unpack_events(message: bytes) -> list:
+    """Returns the events contained in a message; a single event (map or binary record) as well as a batch (array
+    of both)."""
+    if binary.is_binary(message):
+        return [binary.decode(message)]
+    unpacked = msgpack.unpackb(message, raw=False)
+    if isinstance(unpacked, list):
+        return [binary.decode(evt) if isinstance(evt, bytes) else evt for evt in unpacked]
+    return [unpacked]
@@ -0,0 +1,213 @@
+from bisect import bisect_left
+
+from bitcoinde.events import Event, EventSink
+
+SNAPSHOT_FIELDS = ("id", "order_id", "price", "amount", "min_amount", "po")  # columns of the rows of snapshot
+
+
+class Order(object):
+    """An order of the book; price is given in cents (as produced by BitcoinWebSocketAddOrder), amount in coins.
+    Orders taken from a REST snapshot have no websocket id; they are keyed by their order_id instead."""
+    __slots__ = ("id", "order_id", "key", "trading_pair", "order_type", "price", "amount", "min_amount", "po",
+                 "data")
+
+    def __init__(self, data: dict):
+        self.id = int(data["id"]) if data.get("id") is not None else None
+        self.order_id = data.get("order_id")
+        self.key = self.id if self.id is not None else self.order_id
+        self.trading_pair = data.get("trading_pair")
+        self.order_type = data.get("order_type")
+        self.price = data["price"]
+        self.amount = data["amount"]
+        self.min_amount = data.get("min_amount")
+        self.po = data.get("po", 0)
+        self.data = data  # the complete event data
+
+
+class PriceLevel(object):
+    """All orders of one side of the book having the same price."""
+    __slots__ = ("price", "amount", "orders")
+
+    def __init__(self, price: int):
+        self.price = price
+        self.amount = 0.
+        self.orders = {}  # order key -> Order
+
+
+class OrderBookSide(object):
+    """One side of a book. Price levels are kept in a dict for O(1) access, and their prices in an ascending list
+    for the order; the best price is at the end (bids) or at the front (asks) of the list, so it is O(1) too.
+    Only creating or dropping a level touches the list (binary search plus a memmove).
+
+    Watchers are called with the price of every level that changes (None, if the side has been cleared)."""
+
+    def __init__(self, descending: bool):
+        self.descending = descending  # True for bids, the best price is the highest one
+        self.levels = {}  # price -> PriceLevel
+        self.prices = []  # ascending
+        self.watchers = []
+
+    def __len__(self):
+        return len(self.prices)
+
+    def best(self) -> PriceLevel:
+        """Returns the best price level, or None if the side is empty."""
+        if len(self.prices) == 0:
+            return None
+        return self.levels[self.prices[-1] if self.descending else self.prices[0]]
+
+    def add(self, order: Order):
+        level = self.levels.get(order.price, None)
+        if level is None:
+            level = self.levels[order.price] = PriceLevel(order.price)
+            prices = self.prices
+            prices.insert(bisect_left(prices, order.price), order.price)
+        level.orders[order.key] = order
+        level.amount += order.amount
+        for watcher in self.watchers:
+            watcher(order.price)
+
+    def remove(self, order: Order):
+        level = self.levels.get(order.price, None)
+        if level is None or level.orders.pop(order.key, None) is None:
+            return
+        if len(level.orders) == 0:
+            del self.levels[order.price]
+            prices = self.prices
+            del prices[bisect_left(prices, order.price)]
+        else:
+            level.amount -= order.amount
+        for watcher in self.watchers:
+            watcher(order.price)
+
+    def clear(self):
+        self.levels, self.prices = {}, []
+        for watcher in self.watchers:
+            watcher(None)
+
+    def iterate(self):
+        """Yields the price levels, best price first."""
+        levels = self.levels
+        for price in (reversed(self.prices) if self.descending else self.prices):
+            yield levels[price]
+
+
+class TradingPairBook(object):
+    """The buy side (bids) and sell side (asks) of one trading pair."""
+
+    def __init__(self, trading_pair: str):
+        self.trading_pair = trading_pair
+        self.bids = OrderBookSide(True)
+        self.asks = OrderBookSide(False)
+
+    def side(self, order_type: str) -> OrderBookSide:
+        return self.bids if order_type == "buy" else self.asks
+
+    def best_bid(self) -> PriceLevel:
+        return self.bids.best()
+
+    def best_ask(self) -> PriceLevel:
+        return self.asks.best()
+
+    def spread(self):
+        """Returns the difference between best ask and best bid in cents, or None if a side is empty."""
+        bid, ask = self.bids.best(), self.asks.best()
+        if bid is None or ask is None:
+            return None
+        return ask.price - bid.price
+
+
+class OrderBook(EventSink):
+    """Maintains the order books of all trading pairs from add, rm and po events. An order-id index allows removing
+    orders and refreshing their payment options in O(1)."""
+
+    def __init__(self):
+        self.books = {}  # trading pair -> TradingPairBook
+        self.orders = {}  # order key (the websocket id, or the order_id of snapshot orders) -> Order
+        self.order_ids = {}  # order_id -> Order
+
+    def book(self, trading_pair: str) -> TradingPairBook:
+        book = self.books.get(trading_pair, None)
+        if book is None:
+            book = self.books[trading_pair] = TradingPairBook(trading_pair)
+        return book
+
+    def process_event(self, event: Event):
+        event_type = event.event_type
+        if event_type == "add":
+            self.add(event.event_data)
+        elif event_type == "rm":
+            data = event.event_data
+            self.remove(data["id"], data.get("order_id"))
+        elif event_type == "po":
+            data = event.event_data
+            self.refresh_payment_options(data["ids"], data["po"])
+
+    def add(self, data: dict) -> Order:
+        order = Order(data)
+        self.remove(order.id, order.order_id)
+        self.orders[order.key] = order
+        if order.order_id is not None:
+            self.order_ids[order.order_id] = order
+        self.book(order.trading_pair).side(order.order_type).add(order)
+        return order
+
+    def find(self, id, order_id=None) -> Order:
+        """Looks up an order by its websocket id, or by its order_id."""
+        order = self.orders.get(int(id), None) if id is not None else None
+        if order is None and order_id is not None:
+            order = self.order_ids.get(order_id, None)
+        return order
+
+    def remove(self, id, order_id=None) -> Order:
+        """Removes the order with the given id (or order_id); returns None, if the order is unknown."""
+        order = self.find(id, order_id)
+        if order is not None:
+            del self.orders[order.key]
+            if order.order_id is not None:
+                self.order_ids.pop(order.order_id, None)
+            self.books[order.trading_pair].side(order.order_type).remove(order)
+        return order
+
+    def refresh_payment_option(self, id, po: int) -> Order:
+        order = self.find(id)
+        if order is not None:
+            order.po = po
+        return order
+
+    def refresh_payment_options(self, ids: list, po: list) -> int:
+        """Applies the parallel arrays of a po event; returns the number of unknown orders."""
+        orders, unknown = self.orders, 0
+        for id, payment_option in zip(ids, po):
+            order = orders.get(int(id), None)
+            if order is None:
+                unknown += 1
+            else:
+                order.po = payment_option
+        return unknown
+
+    def snapshot(self, trading_pairs=None) -> dict:
+        """Returns the orders of the given trading pairs (default: all) as rows of SNAPSHOT_FIELDS, best price
+        first: {trading pair: {"bids": [...], "asks": [...]}}."""
+        result = {}
+        for trading_pair, book in self.books.items():
+            if trading_pairs is not None and trading_pair not in trading_pairs:
+                continue
+            sides = result[trading_pair] = {}
+            for name, side in (("bids", book.bids), ("asks", book.asks)):
+                sides[name] = [[order.id, order.order_id, order.price, order.amount, order.min_amount, order.po]
+                               for level in side.iterate() for order in level.orders.values()]
+        return result
+
+    def replace(self, trading_pair: str, orders: list):
+        """Replaces the book of the given trading pair by the given order data, for instance a snapshot."""
+        book = self.book(trading_pair)
+        for side in (book.bids, book.asks):
+            for level in side.levels.values():
+                for order in level.orders.values():
+                    del self.orders[order.key]
+                    if order.order_id is not None:
+                        self.order_ids.pop(order.order_id, None)
+            side.clear()
+        for data in orders:
+            self.add(data)
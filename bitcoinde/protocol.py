@@ -1,12 +1,15 @@
+import re
 from time import time
 from hashlib import sha1
 from json import loads
 from os import urandom
 from base64 import b64encode  # Websocket Key handling
-from struct import unpack  # Websocket Length handling
 from twisted.protocols import basic
 from twisted.internet import reactor
 
+from bitcoinde.frames import WebSocketFrameDecoder, OPCODE_TEXT, OPCODE_CLOSE
+from bitcoinde.keepalive import KeepAlive
+
 
 class ClientIo0916Protocol(basic.LineReceiver):
     """Implements a receiver able to interact with the websocket part of a JS clientIO server.
@@ -14,6 +17,8 @@ Requests options from the clientIO server and if websocket is available, upgrade
 After acting as a basic.LineReceiver to process the http GET,UPGRADE part (lineReceived), switch to RAW
 mode (rawDataReceived)."""
     _MAGIC = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"  # Handshake key signing
+    heart_beat_interval = 25
+    stale_timeout = 60  # reconnect if nothing has been received for this number of seconds
 
     def __init__(self):
         self.state = 0
@@ -26,6 +31,11 @@ mode (rawDataReceived)."""
         self.last_ping_at = 0
         self.ping_interval = 0
 
+        self.decoder = WebSocketFrameDecoder(self.on_frame)
+        self.received_at = 0
+        self.keepalive = KeepAlive(reactor, self.heart_beat, self.on_stale, self.heart_beat_interval,
+                                   self.stale_timeout)
+
     def connectionMade(self):
         """ Called after the factory that was passed this protocol established the connection. """
         self.state = 0  # pseudo state-machine to keep track which phase http-upgrade-websocket the connection is in
@@ -37,11 +47,14 @@ mode (rawDataReceived)."""
         self.last_ping_at = 0
         self.ping_interval = 0
 
+        self.decoder.reset()
+
         self.setLineMode()  # for the http part, process the packet line-wise
         data = "GET /socket.io/1/?t=%d HTTP/1.1\n" % (time() * 1000)
         self.sendLine(data.encode('utf8'))  # first GET request
 
     def heart_beat(self):
+        """Sends a socket.io 0.9 heartbeat. It is not answered, so no round trip time is measured for 0.9."""
         self.pong_count += 1
         pong = bytearray([129, 3]) + b"2::"
         # pong = bytearray([1,3])+bytes("2::") # Produces more reconnects
@@ -85,37 +98,33 @@ mode (rawDataReceived)."""
                 self.http_pos = ""
 
     def rawDataReceived(self, data):
-        t = time()
-        if type(data) == str:
-            data = bytearray(data)
         if self.state == 2:
             self.state = 3
-        elif self.state == 3:
-            # Calculate the length
-            length, b = data[1] & 0b1111111, 2  # Handle the length field
-
-            if length == 126:
-                b = 4
-                length = unpack('!H', data[2:4])[0]  # struct.unpack
-            elif length == 127:
-                b = 10
-                length = unpack('!Q', data[2:10])[0]
-            # Different Opcodes
-
-            if data[b] == 47:
-                pass  # print(data)
-            elif data[b] == 48:
-                self.ping_count += 1
-                self.process_ping(data[b:])
-
-            elif data[b] == 53:
-                self.on_packet_received(data[b:].decode("utf8"), length - b, t)
-            else:
-                print("Unknown op-code", data)
-            reactor.callLater(25, self.heart_beat)
+            self.keepalive.start()
+        if self.state == 3:
+            self.received_at = time()
+            self.keepalive.data_received()
+            self.factory.on_raw_data(data, self.received_at)
+            self.decoder.feed(data)
         else:
             print("Unknown state", self.state)
 
+    def on_frame(self, opcode, payload):
+        """Processes a complete WebSocket message; payload is only valid during the call."""
+        if opcode == OPCODE_TEXT:
+            packet_type = payload[0] if len(payload) > 0 else 0
+            if packet_type == 47 or packet_type == 49:
+                pass  # endpoint or connect acknowledgement
+            elif packet_type == 48:
+                self.ping_count += 1
+                self.process_ping(payload)
+            elif packet_type == 53:
+                self.on_packet_received(str(payload, "utf8"), len(payload), self.received_at)
+            else:
+                print("Unknown op-code", bytes(payload))
+        elif opcode == OPCODE_CLOSE:
+            self.transport.loseConnection()
+
     def process_ping(self, data):
         now = time()
         if self.last_ping_at != 0:
@@ -164,11 +173,17 @@ mode (rawDataReceived)."""
     def terminate(self, reason):
         print("ClientIo0916Protocol.terminate", reason)
 
+    def on_stale(self, idle_seconds):
+        """Aborts a silent connection; the ClientService reconnects."""
+        print("ClientIo0916Protocol: nothing received for %.0f s, reconnecting" % idle_seconds)
+        self.transport.abortConnection()
+
     def on_packet_received(self, data, length, t):
         """Must be implemented by a derived type."""
         print("ClientIo0916Protocol.on_packet_received", length, data)
 
     def connectionLost(self, reason):
+        self.keepalive.stop()
         print("ClientIo0916Protocol.connectionLost", reason)
 
 
@@ -176,10 +191,15 @@ class WebSocketJsonBitcoinDEProtocol(ClientIo0916Protocol):
     """ Processes the Content of the Websocket packet treating it as JSON and pass the dict to an onEvent-function
     mimicking the original js behaviour"""
 
+    _EVENT_NAME = re.compile(r'"name"\s*:\s*"([^"]+)"')
+
     def on_packet_received(self, data, length, t):
         i = 1
         while data[i] == ":":
             i += 1
+        match = self._EVENT_NAME.search(data, i)
+        if match is not None and self.factory.on_raw_event(match.group(1), data, t):
+            return  # already seen from another source, skip decoding
         json_data = loads(data[i:])  # json.loads
         event_type, args = json_data["name"], json_data["args"][0]
         self.factory.on_event(event_type, args, t)
@@ -188,6 +208,7 @@ class WebSocketJsonBitcoinDEProtocol(ClientIo0916Protocol):
         print("WebSocketJsonBitcoinDEProtocol.terminate(%s)", reason)
 
     def connectionLost(self, reason):
+        self.keepalive.stop()
         print("WebSocketJsonBitcoinDEProtocol.connectionLost", reason)
 
 
@@ -195,6 +216,7 @@ class WebSocketJsonBitcoinDEProtocol(ClientIo0916Protocol):
 
 class ClientIo2011Protocol(basic.LineReceiver):
     _MAGIC = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"  # Handshake key signing
+    _MARKET_EVENT = b"42/market,"
 
     def connectionMade(self):
         self.nonce = time() * 1000
@@ -203,7 +225,10 @@ class ClientIo2011Protocol(basic.LineReceiver):
 
         self.pingInterval = 20
         self.ping_count = 0
-        self.next_len = 0
+
+        self.decoder = WebSocketFrameDecoder(self.on_frame)
+        self.received_at = 0
+        self.keepalive = KeepAlive(reactor, self.send_ping, self.on_stale, self.pingInterval, self.pingInterval * 3)
 
         self.setLineMode()
         self.send_init()
@@ -276,36 +301,28 @@ class ClientIo2011Protocol(basic.LineReceiver):
         key_accept = b64encode(hash_algorithm.digest()).decode('utf8')
         if key_got == key_accept:
             self.setRawMode()
-            reactor.callLater(3, self.send_ping)
+            self.keepalive.interval = self.pingInterval
+            self.keepalive.timeout = self.pingInterval * 3  # no data and no pong for three ping intervals
+            self.keepalive.start(3)
             reactor.callLater(2, self.request_market)
             print("WS 2.0 connection accepted")
 
     def rawDataReceived(self, data):
-        if type(data) == str:
-            data = bytearray(data)
-
-        t = time()
-        if len(data) > 4:
-            # print self.next_len,map(ord,data[:8]),data[:20],data[-20:]
-            sd = data.split("42/market,".encode('utf8'))
-            if len(sd) >= 2:
-                # len(data),self.next_len	# socket.io does weird things with it's length==4 packets...
-                content = (sd[1]).decode('utf8')
-                self.on_packet_received(content, len(content), t)
-
-                self.next_len = 0
-        elif len(data) == 4:
-            self.next_len = unpack('!H', data[2:4])[0]
-        elif len(data) == 3:
-            if data[1] == 1 and data[2] == 51:
-                reactor.callLater(self.pingInterval, self.send_ping)
-                self.next_len = 0
-            else:
-                self.next_len = 0
-                # print("short unknown")
-        else:
-            self.next_len = 0
-            # print("Unknown", data)
+        self.received_at = time()
+        self.keepalive.data_received()
+        self.factory.on_raw_data(data, self.received_at)
+        self.decoder.feed(data)
+
+    def on_frame(self, opcode, payload):
+        """Processes a complete WebSocket message; payload is only valid during the call."""
+        if opcode == OPCODE_TEXT:
+            if payload[:10] == self._MARKET_EVENT:
+                content = str(payload[10:], "utf8")
+                self.on_packet_received(content, len(content), self.received_at)
+            elif payload == b"3":  # pong
+                self.keepalive.pong_received()
+        elif opcode == OPCODE_CLOSE:
+            self.transport.loseConnection()
 
     def send_ping(self):
         self.ping_count += 1
@@ -322,11 +339,17 @@ class ClientIo2011Protocol(basic.LineReceiver):
     def terminate(self, reason):
         print("Terminate", reason)
 
+    def on_stale(self, idle_seconds):
+        """Aborts a silent connection; the ClientService reconnects."""
+        print("ClientIo2011Protocol: nothing received for %.0f s, reconnecting" % idle_seconds)
+        self.transport.abortConnection()
+
     def on_packet_received(self, data, length, t):
         """ Dummy, implement Your own websocket-packet-processing"""
         print("Packet", length, data)
 
     def connectionLost(self, reason):
+        self.keepalive.stop()
         print("connectionLost", reason)
 
 
@@ -336,11 +359,14 @@ class WebSocketJsonBitcoinDEProtocol2(ClientIo2011Protocol):
 
     def on_packet_received(self, data, length, t):
         di = data.index(',')
-        evt, args = data[2:di - 1], loads(data[di + 1:-1])
-        self.factory.on_event(evt, args, t)
+        evt, raw = data[2:di - 1], data[di + 1:-1]
+        if self.factory.on_raw_event(evt, raw, t):
+            return  # already seen from another source, skip decoding
+        self.factory.on_event(evt, loads(raw), t)
 
     def terminate(self, reason):
         print("WebSocketJsonBitcoinDEProtocol2.terminate", reason)
 
     def connectionLost(self, reason):
+        self.keepalive.stop()
         print("WebSocketJsonBitcoinDEProtocol2.connectionLost", reason)
\ No newline at end of file
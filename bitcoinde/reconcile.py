@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+from contextlib import nullcontext
+from time import time
+
+from bitcoinde.events import Event, EventSink
+from bitcoinde.orderbook import OrderBook
+
+
+def snapshot_order(order: dict) -> dict:
+    """Converts an order of the showOrderbook REST response to the form of the websocket add events."""
+    requirements = order.get("order_requirements", {})
+    return {"id": None,
+            "order_id": order["order_id"],
+            "trading_pair": order["trading_pair"],
+            "order_type": order["type"],
+            "price": int(float(order["price"]) * 100),
+            "amount": float(order["max_amount"]),
+            "min_amount": float(order.get("min_amount", 0)),
+            "po": int(requirements.get("payment_option", 0))}
+
+
+class OrderBookReconciler(EventSink):
+    """Keeps an OrderBook in sync with the exchange: the book is seeded from showOrderbook (buy and sell) fetched
+    through a client with APIRequest (bitcoinde.rest.BitcoinDeRestClient), websocket deltas received during the fetch
+    are replayed on top of the snapshot, and the book is resynchronized periodically or after gaps have been detected
+    (rm/po events for unknown orders). Only the trading pairs that show gaps are refetched, at most once per
+    min_resync_seconds, each resync costs two showOrderbook calls per pair.
+
+    REST orders carry no websocket id; the ids seen in add events are remembered per order_id and assigned to the
+    snapshot orders, so later rm/po events match them. After each resync, the divergence between the local book
+    and the synced one is reported via last_report. Snapshots are applied on the reactor thread, so the reconciler
+    has to be registered with write_to(reconciler, queue_size=0). If the book is read by another thread, set lock:
+    snapshots are applied holding it (deltas have to be delivered holding it, see ZeroMqSnapshotServer)."""
+
+    def __init__(self, api, trading_pairs=("btceur",), book: OrderBook = None, resync_seconds=3600.,
+                 gap_threshold=3, min_resync_seconds=120., priority=0):
+        self.api = api
+        self.trading_pairs = list(trading_pairs)
+        self.book = book if book is not None else OrderBook()
+        self.resync_seconds = resync_seconds
+        self.gap_threshold = gap_threshold
+        self.min_resync_seconds = min_resync_seconds
+        self.priority = priority  # request priority for PriorityBitcoinDeAPI
+
+        self.fetching = None  # set of trading pairs currently fetched
+        self.buffer = []  # deltas received while fetching
+        self.gaps = {}  # trading pair -> number of detected gaps since the last sync
+        self.last_sync_at = {}  # trading pair -> time of last snapshot
+        self.last_report = {}  # trading pair -> divergence found by the last resync
+        self.ids = {}  # order_id -> websocket id, learned from add events
+        self.lock = None
+
+        from twisted.internet import task
+        self.check_task = task.LoopingCall(self.check)
+
+    def start(self) -> OrderBookReconciler:
+        self.resync(self.trading_pairs)
+        self.check_task.start(min(self.min_resync_seconds, self.resync_seconds), False)
+        return self
+
+    def stop(self):
+        if self.check_task.running:
+            self.check_task.stop()
+
+    def process_event(self, event: Event):
+        """Applies the delta to the book; during a fetch it is also buffered to be replayed on the snapshot."""
+        if self.fetching is not None:
+            self.buffer.append(event)
+        event_type, data = event.event_type, event.event_data
+        if event_type == "add":
+            order = self.book.add(data)
+            if order.order_id is not None:
+                self.ids[order.order_id] = order.id
+        elif event_type == "rm":
+            if self.book.remove(data["id"], data.get("order_id")) is None:
+                self.gap(data.get("trading_pair"))
+        elif event_type == "po":
+            if self.book.refresh_payment_options(data["ids"], data["po"]) > 0:
+                self.gap(None)
+
+    def gap(self, trading_pair):
+        """Records a gap; if the trading pair is unknown, all pairs are affected."""
+        for pair in ([trading_pair] if trading_pair in self.trading_pairs else self.trading_pairs):
+            self.gaps[pair] = self.gaps.get(pair, 0) + 1
+
+    def check(self):
+        """Resyncs the trading pairs that are due, either periodically or because of gaps."""
+        now = time()
+        pairs = []
+        for pair in self.trading_pairs:
+            since = now - self.last_sync_at.get(pair, 0)
+            if since >= self.resync_seconds or \
+                    (since >= self.min_resync_seconds and self.gaps.get(pair, 0) >= self.gap_threshold):
+                pairs.append(pair)
+        if len(pairs) > 0:
+            self.resync(pairs)
+
+    def resync(self, trading_pairs: list):
+        if self.fetching is not None:
+            return
+        from twisted.internet.defer import DeferredList
+        self.fetching, self.buffer = set(trading_pairs), []
+        requests = []
+        for pair in trading_pairs:
+            for order_type in ("buy", "sell"):
+                requests.append(self.api.APIRequest("showOrderbook", type=order_type, trading_pair=pair,
+                                                    priority=self.priority, unique=True))  # never from the cache
+        DeferredList(requests, consumeErrors=True).addCallback(self.on_snapshot, trading_pairs)
+
+    def on_snapshot(self, results: list, trading_pairs: list):
+        orders, failed = {}, set()
+        for i, (success, response) in enumerate(results):
+            pair = trading_pairs[i // 2]
+            if not success or not isinstance(response, dict) or "orders" not in response:
+                print("OrderBookReconciler: fetching %s failed" % pair, response)
+                failed.add(pair)
+            else:
+                snapshot = orders.setdefault(pair, [])
+                for order in response["orders"]:
+                    data = snapshot_order(order)
+                    data["id"] = self.ids.get(data["order_id"], None)
+                    snapshot.append(data)
+
+        buffer, self.fetching, self.buffer = self.buffer, None, []
+        resynced, local = [pair for pair in trading_pairs if pair not in failed], {}
+        with self.lock if self.lock is not None else nullcontext():
+            for pair in resynced:
+                local[pair] = self.orders_of(pair)
+                self.book.replace(pair, orders.get(pair, []))
+
+            for event in buffer:  # replay the deltas received during the fetch on top of the snapshots
+                data = event.event_data
+                if event.event_type == "add" and data.get("trading_pair") in resynced:
+                    self.book.add(data)
+                elif event.event_type == "rm":
+                    self.book.remove(data["id"], data.get("order_id"))
+                elif event.event_type == "po":
+                    self.book.refresh_payment_options(data["ids"], data["po"])
+
+            order_ids = self.book.order_ids
+            self.ids = dict((order_id, id) for order_id, id in self.ids.items() if order_id in order_ids)
+
+        now = time()
+        for pair in resynced:
+            self.last_report[pair] = self.divergence(local[pair], self.orders_of(pair))
+            self.gaps[pair] = 0
+            self.last_sync_at[pair] = now
+            print("OrderBookReconciler: resynced %s" % pair, self.last_report[pair])
+
+    def orders_of(self, trading_pair: str) -> dict:
+        """Returns order_id -> (price, amount) of all orders of the trading pair."""
+        result = {}
+        book = self.book.books.get(trading_pair, None)
+        if book is not None:
+            for side in (book.bids, book.asks):
+                for level in side.levels.values():
+                    for order in level.orders.values():
+                        result[order.order_id] = (order.price, order.amount)
+        return result
+
+    @staticmethod
+    def divergence(local: dict, synced: dict) -> dict:
+        """Counts the orders the local book was missing, the ones it should not have had and the ones that differ
+        in price or amount."""
+        missing, changed = 0, 0
+        for order_id, (price, amount) in synced.items():
+            order = local.get(order_id, None)
+            if order is None:
+                missing += 1
+            elif order[0] != price or abs(order[1] - amount) > 1e-8:
+                changed += 1
+        stale = sum(1 for order_id in local if order_id not in synced)
+        return {"at": time(), "orders": len(synced), "missing": missing, "stale": stale, "changed": changed}
@@ -0,0 +1,143 @@
+"""Replays a capture (see bitcoinde.capture) through the protocol classes, event handlers and sinks, offline.
+
+Usage: python -m bitcoinde.replay CAPTURE [--speed N] [--journal DIR] [--port PORT]
+
+speed 1 replays at the original pace, N at N times the original pace, 0 as fast as possible. The received data is
+fed to the frame decoders of one protocol instance per source, bypassing handshake and keepalive; events keep their
+original receive times and the deduplication windows advance with them, so replays are deterministic.
+"""
+import argparse
+from time import perf_counter, sleep
+
+from twisted.internet import task
+from twisted.internet.testing import StringTransport
+
+from bitcoinde.capture import read_capture
+from bitcoinde.factories import BitcoinWSSourceV09, BitcoinWSSourceV20
+
+STAGES = ("feed", "dedup", "handle", "deliver")  # each stage includes the following ones, except dedup
+
+
+class Replay(object):
+    """Feeds a capture into a BitcoinWebSocketMulti (created with servers=[]) and measures the time spent per
+    stage: feed (frame decoding, parsing and everything below, per received chunk), dedup (raw pre-dedup stage),
+    handle (event handler and delivery) and deliver (all sinks)."""
+
+    def __init__(self, multi, path: str, speed=0.):
+        self.multi = multi
+        self.path = path
+        self.speed = speed
+        self.protocols = {}  # source id -> protocol instance
+        self.clock = task.Clock()  # drives the event handlers' clean-up in capture time
+        self.durations = dict((stage, []) for stage in STAGES)
+        self.behind = []  # seconds the replay was behind the schedule (paced replays only)
+        self.chunks = 0
+        self.elapsed = 0.
+        self.instrument()
+
+    def instrument(self):
+        multi = self.multi
+
+        def timed(f, durations: list):
+            def wrapper(*args):
+                started = perf_counter()
+                try:
+                    return f(*args)
+                finally:
+                    durations.append(perf_counter() - started)
+            return wrapper
+
+        multi.receive_raw_event = timed(multi.receive_raw_event, self.durations["dedup"])
+        multi.receive_event = timed(multi.receive_event, self.durations["handle"])
+        multi.deliver = timed(multi.deliver, self.durations["deliver"])
+
+    def protocol(self, sid: int, version: int):
+        protocol = self.protocols.get(sid, None)
+        if protocol is None:
+            factory = (BitcoinWSSourceV09 if version == 9 else BitcoinWSSourceV20)(sid, self.multi)
+            protocol = self.protocols[sid] = factory.buildProtocol(None)
+            protocol.makeConnection(StringTransport())  # requests are written to the transport and dropped
+        return protocol
+
+    def start_clock(self, t: float):
+        self.clock.advance(t)
+        for handler in self.multi.event_handlers.values():
+            handler.check_task.stop()
+            handler.check_task.clock = self.clock
+            handler.check_task.start(handler.interval, False)
+
+    def run(self):
+        speed, feed_durations, clock = self.speed, self.durations["feed"], self.clock
+        first, started = None, perf_counter()
+        for t, sid, version, data in read_capture(self.path):
+            if first is None:
+                first = t
+                self.start_clock(t)
+            if speed > 0:
+                scheduled = started + (t - first) / speed
+                now = perf_counter()
+                if scheduled > now:
+                    sleep(scheduled - now)
+                else:
+                    self.behind.append(now - scheduled)
+            if t > clock.seconds():
+                clock.advance(t - clock.seconds())
+            protocol = self.protocol(sid, version)
+            protocol.received_at = t
+            feed_started = perf_counter()
+            protocol.decoder.feed(data)
+            feed_durations.append(perf_counter() - feed_started)
+            self.chunks += 1
+        self.elapsed = perf_counter() - started
+        return self
+
+    def report(self) -> dict:
+        result = {"seconds": self.elapsed, "chunks": self.chunks, "events": len(self.durations["deliver"]),
+                  "events_per_second": len(self.durations["deliver"]) / self.elapsed if self.elapsed > 0 else 0.,
+                  "stages": {}}
+        for stage in STAGES:
+            durations = sorted(self.durations[stage])
+            n = len(durations)
+            result["stages"][stage] = {
+                "calls": n,
+                "total_seconds": sum(durations),
+                "p50_us": durations[n // 2] * 1e6 if n > 0 else 0.,
+                "p99_us": durations[int(n * 0.99)] * 1e6 if n > 0 else 0.,
+                "max_us": durations[-1] * 1e6 if n > 0 else 0.}
+        if self.speed > 0:
+            behind = sorted(self.behind)
+            result["behind_max_seconds"] = behind[-1] if len(behind) > 0 else 0.
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture")
+    parser.add_argument("--speed", type=float, default=0., help="1 = original pace, 0 = as fast as possible")
+    parser.add_argument("--journal", default=None, help="Journals the replayed events to the given directory.")
+    parser.add_argument("--port", type=int, default=None, help="Publishes the replayed events via ZeroMQ.")
+    args = parser.parse_args()
+
+    from bitcoinDEws import BitcoinWebSocketMulti, ZeroMqEventProcessingSink
+    from bitcoinde.journal import EventJournal
+    multi = BitcoinWebSocketMulti(servers=[])
+    if args.journal is not None:
+        multi.write_to(EventJournal(args.journal))
+    if args.port is not None:
+        multi.write_to(ZeroMqEventProcessingSink(args.port), queue_size=0)
+
+    report = Replay(multi, args.capture, args.speed).run().report()
+    for sink in multi.sinks:
+        sink.close()
+    print("%d chunks, %d events in %.3f s: %.0f events/s" % (report["chunks"], report["events"], report["seconds"],
+                                                             report["events_per_second"]))
+    print("stage        calls   total s    p50 us    p99 us    max us")
+    for stage, stats in report["stages"].items():
+        print("%-8s %9d %9.3f %9.1f %9.1f %9.1f" % (stage, stats["calls"], stats["total_seconds"], stats["p50_us"],
+                                                    stats["p99_us"], stats["max_us"]))
+    if "behind_max_seconds" in report:
+        print("at most %.3f s behind the original pace" % report["behind_max_seconds"])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""A minimal client for the public read calls of the bitcoin.de trading API (v1), as used by the order book
+reconciler. bitcoinDEapi.py is the complete client (queue, credits, cache, trading calls), but it is Python 2 code
+and cannot be imported by the websocket process.
+"""
+import hmac
+from collections import deque
+from hashlib import md5, sha256
+from json import loads
+from time import time
+
+from twisted.internet.defer import Deferred, fail
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+API_URI = "https://api.bitcoin.de/v1"
+CALLS = {  # call -> path, as in BitcoinDeAPI.calls
+    "showOrderbook": "/orders",
+    "showOrderbookCompact": "/orders/compact",
+    "showPublicTradeHistory": "/trades/history",
+    "showRates": "/rates",
+}
+
+
+class BitcoinDeRestClient(object):
+    """Signs and issues read calls one at a time over a persistent connection, so nonces reach the API in order.
+    APIRequest mirrors BitcoinDeAPI.APIRequest: the Deferred fires with the decoded response plus its "code" and
+    "phrase". priority and unique are accepted and ignored, there is neither a queue order nor a cache."""
+
+    def __init__(self, reactor, api_key: str, api_secret: str):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        pool = HTTPConnectionPool(reactor)
+        pool.maxPersistentPerHost = 1
+        self.agent = Agent(reactor, pool=pool)
+        self.nonce = int(time())
+        self.waiting = deque()  # (path, params, deferred) of the requests behind the one in flight
+        self.busy = False
+        self.requests = 0
+
+    def APIRequest(self, call: str, **kwargs) -> Deferred:
+        path = CALLS.get(call, None)
+        if path is None:
+            return fail(ValueError("Unsupported call: %s" % call))
+        kwargs.pop("priority", None)
+        kwargs.pop("unique", None)
+        d = Deferred()
+        self.waiting.append((path, kwargs, d))
+        self.issue_next()
+        return d
+
+    def issue_next(self):
+        if self.busy or len(self.waiting) == 0:
+            return
+        path, params, d = self.waiting.popleft()
+        self.busy = True
+        self.request(path, params).addBoth(self.on_done, d)
+
+    def on_done(self, result, d: Deferred):
+        self.busy = False
+        self.issue_next()
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def request(self, path: str, params: dict) -> Deferred:
+        query = "&".join("%s=%s" % (key, params[key]) for key in sorted(params))
+        url = API_URI + path + ("?" + query if len(query) > 0 else "")
+        self.nonce = max(self.nonce + 1, int(time()))
+        message = "GET#%s#%s#%d#%s" % (url, self.api_key, self.nonce, md5(b"").hexdigest())
+        signature = hmac.new(self.api_secret.encode(), message.encode(), sha256).hexdigest()
+        headers = Headers({"X-API-KEY": [self.api_key], "X-API-NONCE": ["%d" % self.nonce],
+                           "X-API-SIGNATURE": [signature]})
+        self.requests += 1
+        return self.agent.request(b"GET", url.encode(), headers).addCallback(self.on_response)
+
+    @staticmethod
+    def on_response(response) -> Deferred:
+        def decode(body: bytes) -> dict:
+            result = loads(body) if len(body) > 0 else {}
+            result.update({"code": response.code, "phrase": response.phrase.decode()})
+            return result
+        return readBody(response).addCallback(decode)
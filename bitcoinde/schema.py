@@ -0,0 +1,91 @@
+"""Compiles declarative payload schemas into specialised converter functions.
+
+A schema is a sequence of Field declarations. compile_schema generates the source of a single function that builds
+the result dict in one expression, with the conversions inlined, so converting a payload neither iterates over the
+schema nor calls a lambda per field. If the generated function fails, the fields are converted one by one to raise a
+SchemaError naming the malformed field.
+"""
+
+CONVERSIONS = {  # conversion name -> expression template; %(v)s stands for the expression reading the field
+    "str": "%(v)s",
+    "int": "int(%(v)s)",
+    "float": "float(%(v)s)",
+    "cents": "int(float(%(v)s) * 100)",  # decimal string to an integer number of cents
+}
+
+
+class SchemaError(ValueError):
+    """Raised for a payload that does not match its schema."""
+
+    def __init__(self, schema_name: str, field, key, value, cause):
+        super(SchemaError, self).__init__("%s: malformed field %s (key %s, value %r): %s" %
+                                          (schema_name, field, key, value, cause))
+        self.field = field
+        self.key = key
+
+
+class Field(object):
+    """Declares a field of the result: name, the payload key(s) it is read from, and the conversion. conversion is
+    the name of one of the CONVERSIONS, or a callable. Optional fields are read with data.get (None if missing).
+    If key is a tuple, the converted values are combined to one integer, the first key being the most significant
+    bit (for instance short = is_shorting * 2 + is_shorting_allowed)."""
+
+    def __init__(self, name: str, key=None, conversion="str", optional=False):
+        if not callable(conversion) and conversion not in CONVERSIONS:
+            raise ValueError("Unknown conversion: %s" % conversion)
+        self.name = name
+        self.key = name if key is None else key
+        self.conversion = conversion
+        self.optional = optional
+
+    def keys(self) -> tuple:
+        return self.key if isinstance(self.key, tuple) else (self.key,)
+
+    def expression(self, key: str, namespace: dict) -> str:
+        """Returns the source code of the conversion of one payload key, registering callables in namespace."""
+        read = "data.get(%r)" % key if self.optional else "data[%r]" % key
+        if callable(self.conversion):
+            name = "convert_%d" % len(namespace)
+            namespace[name] = self.conversion
+            return "%s(%s)" % (name, read)
+        return CONVERSIONS[self.conversion] % {"v": read}
+
+    def source(self, namespace: dict) -> str:
+        keys = self.keys()
+        if len(keys) == 1:
+            return self.expression(keys[0], namespace)
+        n = len(keys) - 1
+        return " + ".join("(%s << %d)" % (self.expression(key, namespace), n - i) if i < n else
+                          self.expression(key, namespace) for i, key in enumerate(keys))
+
+
+def compile_schema(schema_name: str, fields):
+    """Returns a function converting a payload dict according to the given fields; the generated source is
+    available as its source attribute."""
+    fields = list(fields)
+    names = [field.name for field in fields]
+    if len(set(names)) != len(names):
+        raise ValueError("%s: duplicate field names" % schema_name)
+
+    namespace = {}
+    items = ["            %r: %s," % (field.name, field.source(namespace)) for field in fields]
+    checks = [(field.name, key, compile(field.expression(key, namespace), "<schema %s>" % schema_name, "eval"))
+              for field in fields for key in field.keys()]
+
+    def diagnose(data, cause):
+        """Converts the fields one by one to raise a SchemaError for the first malformed one."""
+        if not isinstance(data, dict):
+            raise SchemaError(schema_name, None, None, data, "payload is not a dict") from cause
+        for name, key, check in checks:
+            try:
+                eval(check, namespace, {"data": data})
+            except Exception as e:
+                raise SchemaError(schema_name, name, key, data.get(key), "%s: %s" % (type(e).__name__, e)) from cause
+
+    namespace["diagnose"] = diagnose
+    source = "def convert(data):\n    try:\n        return {\n%s\n        }\n" \
+             "    except Exception as cause:\n        diagnose(data, cause)\n        raise\n" % "\n".join(items)
+    exec(compile(source, "<schema %s>" % schema_name, "exec"), namespace)
+    convert = namespace["convert"]
+    convert.source = source
+    return convert
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+
+LAG_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)  # upper bounds; the last bucket is open
+
+
+class SourceStatistics(object):
+    """Counters of a single source within an event stream."""
+    __slots__ = ("arrivals", "wins", "missed", "lag_sum", "lag_max", "histogram")
+
+    def __init__(self):
+        self.arrivals = 0  # number of events received from this source (including the first arrivals)
+        self.wins = 0  # number of events this source delivered first
+        self.missed = 0  # number of events this source did not deliver at all
+        self.lag_sum = 0.
+        self.lag_max = 0.
+        self.histogram = [0] * (len(LAG_BUCKETS_MS) + 1)  # lag behind the fastest source
+
+    def add(self, other: SourceStatistics):
+        self.arrivals += other.arrivals
+        self.wins += other.wins
+        self.missed += other.missed
+        self.lag_sum += other.lag_sum
+        self.lag_max = max(self.lag_max, other.lag_max)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def summary(self, events: int) -> dict:
+        late = self.arrivals - self.wins
+        return {"arrivals": self.arrivals,
+                "wins": self.wins,
+                "win_rate": self.wins / events if events > 0 else 0.,
+                "missed": self.missed,
+                "lag_avg_ms": self.lag_sum * 1000. / late if late > 0 else 0.,
+                "lag_max_ms": self.lag_max * 1000.,
+                "lag_histogram": list(self.histogram)}
+
+
+class ArrivalStatistics(object):
+    """Cross-source arrival statistics of one event stream. Updating is O(1) per arrival, misses and the
+    first-to-last skew are accounted once per event when it expires from the dedup store. Sources are registered
+    when they are connected, so one that never delivers an event is still accounted as missing every event."""
+
+    def __init__(self, registered=()):
+        self.registered = set(registered)  # source ids that survive a reset
+        self.sources = dict((src, SourceStatistics()) for src in self.registered)  # source id -> SourceStatistics
+        self.events = 0  # number of distinct events
+        self.expired = 0
+        self.skew = [0., 0., 0.]  # min, sum, max of the first-to-last arrival delta of expired events
+
+    def source(self, src) -> SourceStatistics:
+        stats = self.sources.get(src, None)
+        if stats is None:
+            stats = self.sources[src] = SourceStatistics()
+        return stats
+
+    def register(self, src):
+        """Adds a source that is expected to deliver the events of this stream."""
+        self.registered.add(src)
+        self.source(src)
+
+    def first_arrival(self, src):
+        """Records that src delivered a new event first."""
+        stats = self.source(src)
+        stats.arrivals += 1
+        stats.wins += 1
+        self.events += 1
+
+    def late_arrival(self, src, lag: float):
+        """Records that src delivered a known event lag seconds after the fastest source."""
+        stats = self.source(src)
+        stats.arrivals += 1
+        stats.lag_sum += lag
+        if lag > stats.lag_max:
+            stats.lag_max = lag
+        stats.histogram[bisect_left(LAG_BUCKETS_MS, lag * 1000.)] += 1
+
+    def event_expired(self, event):
+        """Accounts the sources that have missed the event and its arrival skew."""
+        seen = set()
+        last = event.timestamp
+        for at, src in event.sources:
+            seen.add(src)
+            if at > last:
+                last = at
+        for src, stats in self.sources.items():
+            if src not in seen:
+                stats.missed += 1
+
+        skew = last - event.timestamp
+        if self.expired == 0 or skew < self.skew[0]:
+            self.skew[0] = skew
+        self.skew[1] += skew
+        self.skew[2] = max(self.skew[2], skew)
+        self.expired += 1
+
+    def summary(self, names: dict) -> dict:
+        """Returns the statistics as a dict; names maps source ids to display names."""
+        return {"events": self.events,
+                "skew_ms": {"min": self.skew[0] * 1000.,
+                            "avg": self.skew[1] * 1000. / self.expired if self.expired > 0 else 0.,
+                            "max": self.skew[2] * 1000.},
+                "sources": dict((names.get(src, src), stats.summary(self.events))
+                                for src, stats in self.sources.items())}
+
+    def reset(self):
+        self.__init__(self.registered)
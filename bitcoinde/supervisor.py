@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+from time import time
+
+
+class SourceSupervisor(object):
+    """Manages the set of connected websocket endpoints of a BitcoinWebSocketMulti based on live arrival
+    statistics. Every interval the win rates (share of events a source delivered first) of the last window are
+    evaluated:
+
+    * connected sources that (almost) never win are demoted, as long as more than min_sources stay connected;
+      min_sources > 1 keeps a warm standby connection that takes over if the fastest source fails,
+    * if fewer than min_sources are connected, a standby endpoint is connected,
+    * every probe_interval, one disconnected endpoint (for instance ws1) is connected for one window and kept
+      only if it wins at least min_win_rate of the events."""
+
+    def __init__(self, multi, min_sources=2, min_win_rate=0.02, min_events=100, interval_seconds=300.,
+                 probe_interval_seconds=3600.):
+        self.multi = multi
+        self.min_sources = min_sources
+        self.min_win_rate = min_win_rate
+        self.min_events = min_events  # windows with fewer events are not evaluated
+        self.interval = interval_seconds
+        self.probe_interval = probe_interval_seconds
+
+        self.standby = [sid for sid in sorted(multi.servers.keys()) if sid not in multi.connService]
+        self.probing = None  # server id of the endpoint that is currently being probed
+        self.last_probe_at = time()
+        self.last_counters, self.last_events = {}, 0
+
+        from twisted.internet import task
+        self.check_task = task.LoopingCall(self.evaluate)
+
+    def start(self, run_immediately=False) -> SourceSupervisor:
+        self.check_task.start(self.interval, run_immediately)
+        return self
+
+    def stop(self):
+        if self.check_task.running:
+            self.check_task.stop()
+
+    def counters(self):
+        """Returns the number of wins per source id and the number of distinct events across all streams."""
+        wins, events = {}, 0
+        for event_handler in self.multi.event_handlers.values():
+            statistics = event_handler.statistics
+            events += statistics.events
+            for sid, source_statistics in statistics.sources.items():
+                wins[sid] = wins.get(sid, 0) + source_statistics.wins
+        return wins, events
+
+    def win_rates(self):
+        """Returns the win rate per connected source within the window since the last call, or None if the
+        window contains too few events."""
+        wins, events = self.counters()
+        if events < self.last_events:  # statistics have been reset in the meantime
+            self.last_counters, self.last_events = {}, 0
+        window = events - self.last_events
+        if window < self.min_events:
+            return None
+        rates = {}
+        for sid in self.multi.connService.keys():
+            rates[sid] = max(0, wins.get(sid, 0) - self.last_counters.get(sid, 0)) / window
+        self.last_counters, self.last_events = wins, events
+        return rates
+
+    def evaluate(self):
+        rates = self.win_rates()
+        if rates is None:
+            return
+
+        if self.probing is not None:
+            sid, self.probing = self.probing, None
+            rate = rates.get(sid, 0.)
+            if rate < self.min_win_rate:
+                print("SourceSupervisor: probed %s does not win (%.3f), disconnecting" % (self.name(sid), rate))
+                self.demote(sid)
+                rates.pop(sid, None)
+            else:
+                print("SourceSupervisor: probed %s wins %.3f, keeping it" % (self.name(sid), rate))
+
+        ranked = sorted(rates.items(), key=lambda x: x[1])
+        connected = len(ranked)
+        for sid, rate in ranked:
+            if connected <= self.min_sources or rate >= self.min_win_rate:
+                break
+            print("SourceSupervisor: demoting %s (win rate %.3f)" % (self.name(sid), rate))
+            self.demote(sid)
+            connected -= 1
+
+        while len(self.multi.connService) < self.min_sources and len(self.standby) > 0:
+            sid = self.standby.pop(0)
+            print("SourceSupervisor: connecting standby %s" % self.name(sid))
+            self.multi.connect(sid)
+
+        now = time()
+        if len(self.standby) > 0 and now - self.last_probe_at >= self.probe_interval:
+            self.last_probe_at = now
+            self.probing = self.standby.pop(0)
+            print("SourceSupervisor: probing %s" % self.name(self.probing))
+            self.multi.connect(self.probing)
+
+    def demote(self, sid: int):
+        self.multi.disconnect(sid)
+        self.standby.append(sid)
+
+    def name(self, sid: int) -> str:
+        return self.multi.servers.get(sid, (str(sid),))[0]
@@ -0,0 +1,67 @@
+from collections import deque
+from math import ceil
+
+
+class TimingWheel(object):
+    """A dict-like store whose entries expire in time-buckets. Inserted keys are appended to the current bucket;
+    every tick opens a new bucket and evicts the oldest ones, so inserting and expiring are O(1) per entry and the
+    eviction work is spread evenly over the ticks instead of scanning the whole store.
+
+    The retention is bounded by retention_seconds. In adaptive mode it follows the cross-source arrival skew that
+    has actually been observed (times a safety factor), but never drops below min_retention_seconds. Skew is only
+    observed for copies arriving within the current retention: a source lagging further behind is never seen, and
+    its duplicates pass as new events. Adaptive mode is therefore off by default."""
+
+    def __init__(self, retention_seconds=60., tick_seconds=1., adaptive=False, min_retention_seconds=10.,
+                 skew_factor=4., skew_decay=0.999):
+        self.tick_seconds = tick_seconds
+        self.retention_seconds = retention_seconds
+        self.min_retention_seconds = min(min_retention_seconds, retention_seconds)
+        self.adaptive = adaptive
+        self.skew_factor = skew_factor
+        self.skew_decay = skew_decay  # applied once per tick, the observed skew slowly forgets old outliers
+        self.skew = 0.
+
+        self.items = {}
+        self.buckets = deque([[]])
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        return self.items.get(key, default)
+
+    def insert(self, key, value):
+        if key not in self.items:
+            self.buckets[-1].append(key)
+        self.items[key] = value
+
+    def observe_skew(self, seconds: float):
+        """Reports the delay between the first and a later arrival of the same event."""
+        if seconds > self.skew:
+            self.skew = seconds
+
+    def retention(self) -> float:
+        """Returns the current retention in seconds."""
+        if not self.adaptive:
+            return self.retention_seconds
+        return max(self.min_retention_seconds, min(self.retention_seconds, self.skew * self.skew_factor))
+
+    def tick(self) -> list:
+        """Advances the wheel by one bucket and returns the values that have expired. If the retention shrinks,
+        at most one additional bucket is evicted per tick, so pauses stay flat."""
+        self.skew *= self.skew_decay
+        self.buckets.append([])
+        keep = int(ceil(self.retention() / self.tick_seconds)) + 1
+        evicted = []
+        for _ in range(2):
+            if len(self.buckets) <= keep:
+                break
+            for key in self.buckets.popleft():
+                value = self.items.pop(key, None)
+                if value is not None:
+                    evicted.append(value)
+        return evicted
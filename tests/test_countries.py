@@ -0,0 +1,73 @@
+import random
+import unittest
+
+from bitcoinde import countries
+from bitcoinde.countries import Countries
+
+
+def without_numpy(function, *args):
+    """Calls the given function with the fallback path of bitcoinde.countries."""
+    saved, countries.numpy = countries.numpy, None
+    try:
+        return function(*args)
+    finally:
+        countries.numpy = saved
+
+
+def random_masks(n: int) -> list:
+    rng = random.Random(7)
+    masks = []
+    for _ in range(n):
+        codes = rng.sample(Countries.codes, rng.randint(0, 4))
+        if rng.random() < 0.05:
+            codes.append("US")
+        masks.append(Countries.encode(codes))
+    return masks
+
+
+class CountriesTest(unittest.TestCase):
+    def test_round_trip(self):
+        table = Countries()
+        for code in Countries.codes:
+            self.assertEqual(table.decode(Countries.encode(code)), [code])
+            self.assertEqual(table.decode(Countries.encode([code])), [code])
+        self.assertEqual(table.decode(Countries.encode(list(Countries.codes))), list(Countries.codes))
+        self.assertEqual(table.decode(Countries.encode(["FR", "DE", "MQ"])), ["DE", "FR", "MQ"])  # table order
+        self.assertEqual(table.decode(Countries.encode(["DE", "DE"])), ["DE"])
+
+    def test_empty(self):
+        for codes in ("", None, []):
+            self.assertEqual(Countries.encode(codes), 0)
+        self.assertEqual(Countries().decode(0), [])
+
+    def test_unknown(self):
+        self.assertEqual(Countries.encode("US"), Countries.UNKNOWN)
+        self.assertEqual(Countries.encode(["US", "JP"]), Countries.UNKNOWN)
+        mask = Countries.encode(["AT", "US"])
+        self.assertEqual(mask, Countries.bits["AT"] | Countries.UNKNOWN)
+        self.assertEqual(Countries().decode(mask), ["AT"])  # the UNKNOWN bit is skipped
+        for code in Countries.codes:
+            self.assertEqual(mask & Countries.encode(code) != 0, code == "AT", code)
+
+    def test_eligible_fallback(self):
+        masks = random_masks(1000)
+        for country in Countries.codes + ("US", ""):
+            expected = [mask & Countries.bits.get(country, 0) != 0 for mask in masks]
+            self.assertEqual(without_numpy(Countries.eligible, masks, country), expected, country)
+        self.assertEqual(without_numpy(Countries.eligible, [], "DE"), [])
+        self.assertEqual(without_numpy(Countries.eligible, [Countries.UNKNOWN], "US"), [False])
+
+    @unittest.skipIf(countries.numpy is None, "numpy is not installed")
+    def test_eligible_numpy(self):
+        masks = random_masks(1000)
+        for country in Countries.codes + ("US", ""):
+            expected = [mask & Countries.bits.get(country, 0) != 0 for mask in masks]
+            result = Countries.eligible(masks, country)
+            self.assertEqual(result.dtype, countries.numpy.bool_)
+            self.assertEqual(result.tolist(), expected, country)
+        self.assertEqual(Countries.eligible([], "DE").tolist(), [])
+        self.assertEqual(Countries.eligible([Countries.UNKNOWN], "US").tolist(), [False])
+
+
+if __name__ == '__main__':
+    unittest.main()